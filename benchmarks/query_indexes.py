@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Benchmarks the effect of the covering indexes added in migration 1.8.0.
+# Builds a synthetic project with --coded-lines coded lines, times a few hot
+# corpus queries without indexes, then adds the indexes (and runs ANALYZE)
+# and times the same queries again.
+#
+#     python benchmarks/query_indexes.py --coded-lines 1000000
+
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from pathlib import Path
+from random import Random
+from time import perf_counter
+from tabulate import tabulate
+from sqlalchemy import text
+from qualitative_coding.corpus import QCCorpus
+from qualitative_coding.migrations.migration_1_8_0 import Migrate_1_8_0
+
+parser = ArgumentParser()
+parser.add_argument("--coded-lines", type=int, default=1_000_000)
+parser.add_argument("--documents", type=int, default=1000)
+parser.add_argument("--codes", type=int, default=300)
+parser.add_argument("--coders", type=int, default=5)
+parser.add_argument("--repeat", type=int, default=5)
+args = parser.parse_args()
+
+PARAGRAPH_LENGTH = 10
+
+def populate(corpus, rng):
+    lines_per_doc = max(1, args.coded_lines // args.documents)
+    docs = [f"interviews/interview_{i:05d}.txt" for i in range(args.documents)]
+    codes = [f"code_{i}" for i in range(args.codes)]
+    coders = [f"coder_{i}" for i in range(args.coders)]
+    with corpus.engine.begin() as conn:
+        conn.execute(text("INSERT INTO coder (name) VALUES (:name)"),
+                [{'name': c} for c in coders])
+        conn.execute(text("INSERT INTO code (name) VALUES (:name)"),
+                [{'name': c} for c in codes])
+        conn.execute(text("INSERT INTO document (file_path, file_hash) VALUES (:fp, '')"),
+                [{'fp': d} for d in docs])
+        conn.execute(text(
+            "INSERT INTO document_index (id, name, time_series, document_id) " +
+            "VALUES (:id, 'paragraphs', 0, :fp)"
+        ), [{'id': i + 1, 'fp': d} for i, d in enumerate(docs)])
+        locations = []
+        for i in range(args.documents):
+            for start in range(0, lines_per_doc, PARAGRAPH_LENGTH):
+                locations.append({
+                    'id': len(locations) + 1,
+                    'start': start,
+                    'end': start + PARAGRAPH_LENGTH,
+                    'ix': i + 1
+                })
+        conn.execute(text(
+            "INSERT INTO location (id, start_line, end_line, document_index_id) " +
+            "VALUES (:id, :start, :end, :ix)"
+        ), locations)
+        coded_lines, associations = [], []
+        paragraphs_per_doc = len(locations) // args.documents
+        for i in range(args.coded_lines):
+            doc = rng.randrange(args.documents)
+            line = rng.randrange(lines_per_doc)
+            location_id = doc * paragraphs_per_doc + line // PARAGRAPH_LENGTH + 1
+            coded_lines.append({
+                'id': i + 1,
+                'line': line,
+                'coder': rng.choice(coders),
+                'code': rng.choice(codes)
+            })
+            associations.append({'cl': i + 1, 'loc': location_id})
+        conn.execute(text(
+            "INSERT INTO coded_line (id, line, coder_id, code_id) " +
+            "VALUES (:id, :line, :coder, :code)"
+        ), coded_lines)
+        conn.execute(text(
+            "INSERT INTO coded_line_location_association (coded_line_id, location_id) " +
+            "VALUES (:cl, :loc)"
+        ), associations)
+    return docs, codes, coders
+
+def time_queries(corpus, docs, codes, coders):
+    queries = {
+        "get_coded_lines(codes)": lambda: corpus.get_coded_lines(codes=codes[:3]),
+        "get_coded_lines(coders, file_list)": lambda: corpus.get_coded_lines(
+                coders=coders[:1], file_list=docs[:10]),
+        "count_codes(coders)": lambda: corpus.count_codes(coders=coders[:1]),
+        "count_codes(unit=paragraph)": lambda: corpus.count_codes(unit="paragraph"),
+        "coded_line_exists": lambda: corpus.coded_line_exists(coders[0], codes[0], 5, docs[0]),
+    }
+    results = {}
+    with corpus.session():
+        for name, query in queries.items():
+            timings = []
+            for i in range(args.repeat):
+                start = perf_counter()
+                query()
+                timings.append(perf_counter() - start)
+            results[name] = min(timings)
+    return results
+
+def main():
+    with TemporaryDirectory() as tempdir:
+        settings_path = Path(tempdir) / "settings.yaml"
+        QCCorpus.initialize(settings_path)
+        corpus = QCCorpus(settings_path)
+        migration = Migrate_1_8_0()
+        migration.revert(settings_path)
+        print(f"Populating {args.coded_lines} coded lines...")
+        docs, codes, coders = populate(corpus, Random(0))
+        before = time_queries(corpus, docs, codes, coders)
+        migration.apply(settings_path)
+        after = time_queries(corpus, docs, codes, coders)
+        rows = [(name, before[name], after[name], before[name] / after[name]) for name in before]
+        print(tabulate(rows, ["Query", "Without indexes (s)", "With indexes (s)", "Speedup"],
+                floatfmt=".4f"))
+
+if __name__ == '__main__':
+    main()
@@ -8,12 +8,14 @@ from qualitative_coding.cli.decorators import (
 
 @click.command()
 @click.option("-s", "--settings", type=click.Path(exists=True), help="Settings file")
+@click.option("-F", "--full", is_flag=True, 
+        help="Re-hash every corpus file, even if it appears unchanged")
 @handle_qc_errors
-def check(settings):
+def check(settings, full):
     "Check project for errors"
     settings_path = settings or os.environ.get("QC_SETTINGS", "settings.yaml")
     log = configure_logger(settings_path)
-    log.info("check")
+    log.info("check", full=full)
     corpus = QCCorpus(settings_path)
     with corpus.session():
-        corpus.validate_corpus_paths()
+        corpus.validate_corpus_paths(full=full)
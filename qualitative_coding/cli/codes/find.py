@@ -29,19 +29,23 @@ from qualitative_coding.logs import configure_logger
 @click.option("-l", "--no-line-numbers", "no_line_numbers", is_flag=True,
         help="Do not show line numbers")
 @click.option("-j", "--json", is_flag=True, help="Export as JSON")
+@click.option("-J", "--jsonl", is_flag=True, 
+        help="Export as newline-delimited JSON, streaming one record per line")
 @handle_qc_errors
 def find(codes, settings, pattern, filenames, coders, depth, unit, recursive_codes, 
-         before, after, no_codes, no_line_numbers, json):
+         before, after, no_codes, no_line_numbers, json, jsonl):
     "Find all coded text"
-    if no_codes and json:
+    if json and jsonl:
+        raise IncompatibleOptions("--json and --jsonl are incompatible")
+    if no_codes and (json or jsonl):
         raise IncompatibleOptions("--no-codes and --json are incompatible")
-    if no_line_numbers and json:
+    if no_line_numbers and (json or jsonl):
         raise IncompatibleOptions("--no-line_numbers and --json are incompatible")
     settings_path = settings or os.environ.get("QC_SETTINGS", "settings.yaml")
     log = configure_logger(settings_path)
     log.info("codes find", codes=codes, pattern=pattern, filenames=filenames, coders=coders,
              depth=depth, unit=unit, recursive_codes=recursive_codes, before=before, 
-             after=after, no_codes=no_codes, json=json)
+             after=after, no_codes=no_codes, json=json, jsonl=jsonl)
     corpus = QCCorpus(settings_path)
     viewer = QCCorpusViewer(corpus)
     if json:
@@ -56,6 +60,18 @@ def find(codes, settings, pattern, filenames, coders, depth, unit, recursive_cod
             file_list=read_file_list(filenames),
             coders=coders,
         )
+    elif jsonl:
+        viewer.show_coded_text_jsonl(
+            codes, 
+            before=before, 
+            after=after, 
+            recursive_codes=recursive_codes,
+            depth=depth,
+            unit=unit,
+            pattern=pattern,
+            file_list=read_file_list(filenames),
+            coders=coders,
+        )
     else:
         viewer.show_coded_text(
             codes, 
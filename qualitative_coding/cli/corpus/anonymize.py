@@ -1,12 +1,14 @@
 import os
+import re
 import click
 import spacy
 import yaml
 from tqdm import tqdm
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from qualitative_coding.corpus import QCCorpus
-from qualitative_coding.exceptions import QCError, IncompatibleOptions
+from qualitative_coding.exceptions import QCError, IncompatibleOptions, InvalidParameter
 from qualitative_coding.helpers import read_file_list
 from qualitative_coding.cli.decorators import handle_qc_errors
 from qualitative_coding.logs import configure_logger
@@ -28,43 +30,113 @@ LABELS = {
 @click.option("-o", "--out-dir", default="anonymized", help="location for anonymized documemts")
 @click.option("-u", "--update", is_flag=True, help="Update documents in place")
 @click.option("-d", "--dryrun", is_flag=True, help="Show diff instead of performing update")
+@click.option("-b", "--batch-size", type=int, default=16, 
+        help="Number of documents per batch when finding named entities")
+@click.option("-j", "--jobs", type=int, default=1, 
+        help="Number of worker processes to use")
 @handle_qc_errors
-def anonymize(settings, pattern, filenames, key, reverse, out_dir, update, dryrun):
+def anonymize(settings, pattern, filenames, key, reverse, out_dir, update, dryrun, 
+        batch_size, jobs):
     "Anonymize corpus files"
     settings_path = settings or os.environ.get("QC_SETTINGS", "settings.yaml")
     key_file = Path(key)
     out_path = Path(out_dir)
     log = configure_logger(settings_path)
     log.info("corpus anonymize", pattern=pattern, filenames=filenames, key=key, 
-             reverse=reverse, out_dir=out_dir, update=update, dryrun=dryrun)
+             reverse=reverse, out_dir=out_dir, update=update, dryrun=dryrun, 
+             batch_size=batch_size, jobs=jobs)
     corpus = QCCorpus(settings_path)
     with corpus.session():
         docs = corpus.get_documents(pattern=pattern, file_list=read_file_list(filenames))
 
+    if batch_size < 1 or jobs < 1:
+        raise InvalidParameter("--batch-size and --jobs must be at least 1.")
+
     if key_file.exists():
         keys = yaml.safe_load(key_file.read_text())
         if reverse:
             keys = reverse_keys(keys)
         out_path.mkdir(exist_ok=True, parents=True)
-        with corpus.session():
-            for doc in docs:
-                source = corpus.corpus_dir / doc.file_path
-                dest = out_path / doc.file_path
-                replace_keys(keys, source, dest)
-                if update:
+        paths = [(corpus.corpus_dir / doc.file_path, out_path / doc.file_path) for doc in docs]
+        replace_keys_in_files(keys, paths, jobs=jobs)
+        if update:
+            with corpus.session():
+                for source, dest in paths:
                     corpus.update_document(source, dest, dryrun)
     else:
         if reverse:
             raise QCError("Cannot use --reverse unless key file exists")
-        doc_paths = [corpus.corpus_dir / doc.file_path for doc in docs]
-        generate_key_file(key, doc_paths, log)
+        with corpus.session():
+            generate_key_file(key, corpus, docs, log, batch_size=batch_size, n_process=jobs)
+
+def replace_keys_in_files(keys, paths, jobs=1):
+    """Replaces keys in each (source, dest) in paths, writing the result to dest.
+    When jobs is greater than 1, files are processed in a pool of worker processes,
+    each of which compiles keys once. Compiling tens of thousands of keys takes 
+    several seconds, so workers only pay off when there are many documents.
+    """
+    if jobs > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=set_keys, 
+                initargs=(keys,)) as pool:
+            list(pool.map(replace_file_keys, *zip(*paths), chunksize=4))
+    else:
+        set_keys(keys)
+        for source, dest in paths:
+            replace_file_keys(source, dest)
 
 def replace_keys(keys, source, dest):
-    text = source.read_text()
-    keys_by_length = [k for l, k in reversed(sorted((len(k), k) for k in keys.keys()))]
-    for key in keys_by_length:
-        text = text.replace(key, keys[key])
-    dest.write_text(text)
+    "Replaces keys in source, writing the result to dest."
+    set_keys(keys)
+    replace_file_keys(source, dest)
+
+replacements = {}
+key_pattern = None
+
+def set_keys(keys):
+    """Sets the keys used by replace_file_keys, compiling them into a pattern.
+    This is a module-level function so that it can initialize worker processes.
+    """
+    global replacements, key_pattern
+    replacements = {str(k): v for k, v in keys.items() if str(k)}
+    key_pattern = compile_keys(replacements)
+
+def replace_file_keys(source, dest):
+    text = Path(source).read_text()
+    if key_pattern:
+        text = key_pattern.sub(lambda match: replacements[match.group()], text)
+    Path(dest).parent.mkdir(parents=True, exist_ok=True)
+    Path(dest).write_text(text)
+
+def compile_keys(keys):
+    """Compiles keys into a regular expression which matches the longest key 
+    starting at the leftmost position, so that all keys can be replaced in a 
+    single pass. Keys are arranged in a trie, so that matching does not need 
+    to try every key at each position of the text.
+    """
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[None] = True
+    return re.compile(trie_pattern(trie)) if trie else None
+
+def trie_pattern(node):
+    """Returns a regular expression matching the keys in a trie node. Chains of 
+    nodes with a single child become literals. When the node ends a key, 
+    the rest of the pattern is optional and greedy, so longer keys are preferred.
+    """
+    branches = []
+    for char in sorted(k for k in node if k is not None):
+        literal, child = char, node[char]
+        while len(child) == 1 and None not in child:
+            (char, child), = child.items()
+            literal += char
+        branches.append(re.escape(literal) + trie_pattern(child))
+    if not branches:
+        return ""
+    pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+    return f"(?:{pattern})?" if None in node else pattern
 
 def reverse_keys(keys):
     """Converts anonymization keys into de-anonymization keys.
@@ -77,9 +149,54 @@ def reverse_keys(keys):
             rkeys[v] = k
     return rkeys
 
-def generate_key_file(key, file_paths, log):
+def generate_key_file(key, corpus, docs, log, batch_size=16, n_process=1):
     """Generates a YAML file containing keys for anonymization.
     A key file is required to anonymize a corpus. 
+    Named entities found in each document are cached in the database by file hash,
+    so only new or changed documents are processed when the key file is generated
+    again. Documents are processed in batches of batch_size, by n_process processes.
+    """
+    file_hashes = {}
+    for doc in docs:
+        path = corpus.corpus_dir / doc.file_path
+        if corpus.file_stat_matches(doc, path.stat()):
+            file_hashes[path] = doc.file_hash
+        else:
+            file_hashes[path] = corpus.hash_file(path)
+    cached = corpus.get_cached_entities(file_hashes.values())
+    pending = {}
+    for path, file_hash in file_hashes.items():
+        if file_hash not in cached:
+            pending.setdefault(file_hash, path)
+    log.info("Finding named entities", documents=len(file_hashes), cached=len(file_hashes) - len(pending))
+    if pending:
+        nlp = load_language_model(log)
+        texts = ((path.read_text(), file_hash) for file_hash, path in pending.items())
+        results = nlp.pipe(texts, as_tuples=True, batch_size=batch_size, n_process=n_process)
+        for i, (doc, file_hash) in enumerate(tqdm(results, total=len(pending), desc="Processing documents")):
+            entities = list(dict.fromkeys(
+                (ent.label_, ent.text) for ent in doc.ents if ent.label_ in LABELS
+            ))
+            corpus.cache_entities(file_hash, entities)
+            cached[file_hash] = entities
+            if (i + 1) % batch_size == 0:
+                corpus.commit_cache()
+        corpus.commit_cache()
+    entities = defaultdict(set)
+    for file_hash in file_hashes.values():
+        for label, text in cached[file_hash]:
+            entities[label].add(text)
+    placeholders = {}
+    for label, terms in entities.items():
+        placeholder = LABELS[label]
+        for i, term in enumerate(sorted(terms)):
+            placeholders[term] = f"{placeholder}_{i+1}"
+    Path(key).write_text(yaml.dump(placeholders))
+
+def load_language_model(log):
+    """Loads the spacy language model, downloading it if necessary. 
+    Pipeline components which are not needed for named entity recognition
+    are disabled.
     """
     model_name = 'en_core_web_sm'
     if spacy.util.is_package(model_name):
@@ -96,17 +213,15 @@ def generate_key_file(key, file_paths, log):
             "failed. Please install the language model manually:\n" +
             "python -m spacy download en_core_web_sm"
         )
-    entities = defaultdict(set)
-    for file_path in tqdm(file_paths, desc="Processing documents"):
-        text = file_path.read_text()
-        doc = nlp(text)
-        for ent in doc.ents:
-            if ent.label_ in LABELS:
-                entities[ent.label_].add(ent)
-    placeholders = {}
-    for label, ents in entities.items():
-        placeholder = LABELS[label]
-        terms = sorted(e.text for e in ents)
-        for i, term in enumerate(terms):
-            placeholders[term] = f"{placeholder}_{i+1}"
-    Path(key).write_text(yaml.dump(placeholders))
+    ner_pipes = ner_pipe_names(nlp)
+    nlp.select_pipes(disable=[name for name in nlp.pipe_names if name not in ner_pipes])
+    return nlp
+
+def ner_pipe_names(nlp):
+    """Returns the names of the pipeline components needed for named entity 
+    recognition: ner, and any shared embedding component (e.g. tok2vec or 
+    transformer) which ner listens to. In en_core_web_sm, ner has its own 
+    embedding layer, so the shared tok2vec is not needed.
+    """
+    return {"ner"} | {name for name, pipe in nlp.pipeline 
+            if "ner" in getattr(pipe, "listening_components", [])}
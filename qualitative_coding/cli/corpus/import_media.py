@@ -1,5 +1,6 @@
 import click
 import os
+from tqdm import tqdm
 from qualitative_coding.corpus import QCCorpus
 from qualitative_coding.cli.decorators import handle_qc_errors
 from qualitative_coding.media_importers import media_importers
@@ -15,18 +16,25 @@ from qualitative_coding.logs import configure_logger
 @click.option("-i", "--importer", type=click.Choice(media_importers.keys()),
         default="pandoc",
         help="Importer class to use")
+@click.option("-j", "--jobs", type=int, default=1, 
+        help="Number of worker processes to use when importing recursively")
 @handle_qc_errors
-def import_media(file_path, settings, recursive, corpus_root, importer):
+def import_media(file_path, settings, recursive, corpus_root, importer, jobs):
     "Import corpus files"
     settings_path = settings or os.environ.get("QC_SETTINGS", "settings.yaml")
     log = configure_logger(settings_path)
     log.info("corpus import", file_path=file_path, recursive=recursive, corpus_root=corpus_root,
-             importer=importer)
+             importer=importer, jobs=jobs)
     corpus = QCCorpus(settings_path)
-    with corpus.session():
+    with corpus.session(), tqdm(desc="Importing documents", disable=not recursive) as bar:
+        def show_progress(completed, total):
+            bar.total = total
+            bar.update(completed - bar.n)
         corpus.import_media(
             file_path, 
             recursive=recursive, 
             corpus_root=corpus_root, 
-            importer=importer
+            importer=importer,
+            jobs=jobs,
+            progress=show_progress,
         )
@@ -9,17 +9,32 @@ from qualitative_coding.cli.decorators import handle_qc_errors
 from qualitative_coding.logs import configure_logger
 
 @click.command()
-@click.argument("file_path", type=click.Path(exists=True))
+@click.argument("file_path", type=click.Path(exists=True), required=False)
 @click.option("-s", "--settings", type=click.Path(exists=True), help="Settings file")
 @click.option("-n", "--new", type=click.Path(exists=True), help="Path to new version")
+@click.option("-N", "--new-dir", type=click.Path(exists=True, file_okay=False), 
+        help="Directory of new versions of corpus files")
+@click.option("-g", "--git-range", help="Update all files changed in a git revision range")
+@click.option("-j", "--jobs", type=int, default=1, 
+        help="Number of worker processes to use when comparing files in --new-dir")
 @click.option("-d", "--dryrun", is_flag=True, 
         help="Show simulated results")
 @handle_qc_errors
-def update(file_path, settings, new, dryrun):
+def update(file_path, settings, new, new_dir, git_range, jobs, dryrun):
     "Update the content of corpus files"
     settings_path = settings or os.environ.get("QC_SETTINGS", "settings.yaml")
     log = configure_logger(settings_path)
-    log.info("corpus update", new=new, dryrun=dryrun)
+    log.info("corpus update", new=new, new_dir=new_dir, git_range=git_range, dryrun=dryrun)
+    if new_dir and git_range:
+        raise IncompatibleOptions("--new-dir and --git-range may not be used together.")
+    if new_dir or git_range:
+        if file_path or new:
+            raise IncompatibleOptions("FILE_PATH and --new may not be used with --new-dir or --git-range.")
+    elif not file_path:
+        raise InvalidParameter("FILE_PATH is required unless --new-dir or --git-range is used.")
     corpus = QCCorpus(settings_path)
     with corpus.session():
-        corpus.update_document(file_path, new, dryrun)
+        if new_dir or git_range:
+            corpus.update_documents(new_dir=new_dir, git_range=git_range, dryrun=dryrun, jobs=jobs)
+        else:
+            corpus.update_document(file_path, new, dryrun)
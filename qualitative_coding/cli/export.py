@@ -10,14 +10,18 @@ from qualitative_coding.cli.decorators import (
 @click.command()
 @click.argument("export_path")
 @click.option("-s", "--settings", type=click.Path(exists=True), help="Settings file")
+@click.option("-j", "--jobs", type=int, default=1, 
+        help="Number of worker processes to use when serializing sources")
+@click.option("-i", "--incremental", is_flag=True, 
+        help="Reuse unchanged sources from an existing archive at export_path")
 @handle_qc_errors
-def export(export_path, settings):
+def export(export_path, settings, jobs, incremental):
     "Export project as REFI-QDA"
     settings_path = settings or os.environ.get("QC_SETTINGS", "settings.yaml")
     corpus = QCCorpus(settings_path)
     with corpus.session():
         corpus.update_codebook()
     path = Path(export_path).with_suffix(".qdpx")
-    writer = REFIQDAWriter(settings_path)
-    writer.write(export_path)
+    writer = REFIQDAWriter(settings_path, jobs=jobs)
+    writer.write(export_path, incremental=incremental)
 
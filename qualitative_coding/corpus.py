@@ -1,35 +1,47 @@
-from itertools import chain, combinations_with_replacement
+from itertools import chain
+from more_itertools import chunked
 from collections import defaultdict
 from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from importlib.metadata import metadata
 from pathlib import Path
 import yaml
+import json
 import shutil
 import numpy as np
 from semver import Version
 import structlog
 from textwrap import fill
 import os
-from hashlib import sha1
+from hashlib import sha1, file_digest
+from time import time_ns
 from pathlib import Path
 from sqlalchemy import (
     create_engine,
+    event,
     select,
+    update,
     delete,
+    and_,
+    or_,
     not_,
     func,
     distinct,
+    literal,
+    union_all,
     text
 )
-from sqlalchemy.exc import NoResultFound
+from sqlalchemy.exc import NoResultFound, OperationalError
 from sqlalchemy.orm import (
     Session,
     aliased,
     sessionmaker,
+    undefer,
 )
 from sqlalchemy.dialects.sqlite import insert
 from qualitative_coding.helpers import prompt_for_choice
 from qualitative_coding.tree_node import TreeNode
+from qualitative_coding.document_reader import DocumentReader
 from qualitative_coding.exceptions import (
     QCError, 
     SettingsError, 
@@ -43,6 +55,7 @@ from qualitative_coding.database.models import (
     Code, 
     Coder, 
     CodedLine,
+    EntityCache,
     coded_line_location_association_table
 )
 from qualitative_coding.editors import editors
@@ -53,7 +66,11 @@ from qualitative_coding.helpers import (
 )
 from qualitative_coding.diff import (
     get_diff, 
+    get_diffs,
     get_git_diff,
+    get_git_range_diffs,
+    get_line_mapping,
+    read_diff_offsets,
     reindex_coded_lines,
     in_git_repo,
 )
@@ -71,7 +88,75 @@ DEFAULT_SETTINGS = {
     'verbose': False,
 }
 
-LATEST_MIGRATION = Version.parse("1.4.0")
+LATEST_MIGRATION = Version.parse("1.8.0")
+
+def convert_media(importer, settings, source_path, dest_path):
+    """Transforms source_path into dest_path using the named media importer.
+    This is a module-level function so that it can be run in worker processes.
+    """
+    media_importers[importer](settings).import_media(source_path, dest_path)
+
+DATABASE_PROFILES = {
+    'safe': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+    },
+    'fast': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -256000,
+        'temp_store': 'MEMORY',
+        'mmap_size': 268435456,
+    },
+    'readonly-analytics': {
+        'query_only': 1,
+        'cache_size': -512000,
+        'temp_store': 'MEMORY',
+        'mmap_size': 4294967296,
+    },
+}
+
+DATABASE_PRAGMAS = {
+    'journal_mode', 
+    'synchronous', 
+    'cache_size', 
+    'temp_store', 
+    'mmap_size', 
+    'query_only',
+    'busy_timeout', 
+    'locking_mode', 
+    'wal_autocheckpoint',
+}
+
+def get_database_pragmas(profile):
+    """Returns a dict of SQLite pragmas for a database profile. 
+    profile may be the name of a preset in DATABASE_PROFILES, or a dict of pragmas
+    with an optional 'preset' key naming the preset the pragmas override. 
+    For example, in settings.yaml:
+
+        database_profile:
+            preset: fast
+            cache_size: -1000000
+
+    Raises SettingsError if the profile is invalid.
+    """
+    if profile is None:
+        return {}
+    if isinstance(profile, str):
+        profile = {'preset': profile}
+    if not isinstance(profile, dict):
+        raise SettingsError("database_profile must be a preset name or a dict of pragmas")
+    pragmas = dict(profile)
+    preset = pragmas.pop('preset', None)
+    if preset is not None and preset not in DATABASE_PROFILES:
+        raise SettingsError(f"Unrecognized database_profile preset {preset}. " + 
+                f"Presets are: {', '.join(DATABASE_PROFILES)}")
+    for name, value in pragmas.items():
+        if name not in DATABASE_PRAGMAS:
+            raise SettingsError(f"Unsupported pragma in database_profile: {name}")
+        if not (isinstance(value, int) or (isinstance(value, str) and value.isalnum())):
+            raise SettingsError(f"Invalid value for database_profile.{name}: {value}")
+    return {**DATABASE_PROFILES.get(preset, {}), **pragmas}
 
 class QCCorpus:
     """Provides data access to the corpus of documents and codes. 
@@ -84,6 +169,8 @@ class QCCorpus:
     """
     
     units = ["line", "paragraph", "document"]
+    batch_size = 500
+    racy_stat_window_ns = 2_000_000_000
 
     @classmethod
     def initialize(cls, settings_path="settings.yaml", only_write_settings_file=False):
@@ -163,6 +250,10 @@ class QCCorpus:
                         errors.append(f"Expected editors.{name} to be a dict")
             if not settings.get('editor') in {**editors, **settings.get('editors', {})}:
                 errors.append(f"Unrecognized editor {settings.get('editor')}")
+            try:
+                get_database_pragmas(settings.get('database_profile'))
+            except SettingsError as err:
+                errors.append(str(err))
             if errors:
                 raise SettingsError()
         except SettingsError:
@@ -171,7 +262,9 @@ class QCCorpus:
         finally:
             log.debug("Validating settings", errors=errors, settings_path=str(settings_path))
 
-    def __init__(self, settings_path, skip_validation=False):
+    def __init__(self, settings_path, skip_validation=False, database_profile=None):
+        """When database_profile is given, it overrides settings['database_profile'].
+        """
         self.settings_path = Path(settings_path)
         self.settings = read_settings(settings_path)
         if not skip_validation:
@@ -181,6 +274,21 @@ class QCCorpus:
         self.codebook_path = self.resolve_path(self.settings['codebook'])
         db_file = self.resolve_path(self.settings['database'])
         self.engine = create_engine(f"sqlite:///{db_file}")
+        try:
+            self.pragmas = get_database_pragmas(
+                database_profile or self.settings.get('database_profile')
+            )
+        except SettingsError as err:
+            raise QCError(f"Invalid database_profile: {err}")
+        if self.pragmas:
+            event.listen(self.engine, "connect", self.set_pragmas)
+
+    def set_pragmas(self, dbapi_connection, connection_record):
+        "Applies the database profile's pragmas to each new connection."
+        cursor = dbapi_connection.cursor()
+        for name, value in self.pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
 
     class NotInSession(Exception):
         def __init__(self, *args, **kwargs):
@@ -206,7 +314,11 @@ class QCCorpus:
 
         session_context_manager = Session(self.engine)
         self.session = session_context_manager.__enter__()
+        self.paragraph_lookups = {}
+        self.query_only = None
         yield
+        del self.query_only
+        del self.paragraph_lookups
         del self.session
         session_context_manager.__exit__(None, None, None)
 
@@ -217,6 +329,30 @@ class QCCorpus:
         except AttributeError:
             raise self.NotInSession()
 
+    def is_query_only(self):
+        """Returns True when the database connection may not be written, as under
+        the readonly-analytics database profile.
+        """
+        if self.query_only is None:
+            self.query_only = bool(self.get_session().scalar(text("PRAGMA query_only")))
+        return self.query_only
+
+    def commit_cache(self):
+        """Commits data which is cached in the database because it is expensive to 
+        recompute, such as line offsets and verified file stats. Caching is an 
+        optimization, so when the database cannot be written the changes are 
+        rolled back instead of raising an error.
+        """
+        session = self.get_session()
+        if self.is_query_only():
+            session.rollback()
+            return
+        try:
+            session.commit()
+        except OperationalError as err:
+            log.warning("Could not write cached data to the database", error=str(err))
+            session.rollback()
+
     def resolve_path(self, path):
         "Returns a path relative to self.settings_path"
         path = Path(path)
@@ -244,12 +380,15 @@ class QCCorpus:
         if errors:
             raise QCError("Invalid settings:\n" + "\n".join([f"- {err}" for err in errors]))
 
-    def validate_corpus_paths(self):
+    def validate_corpus_paths(self, full=False):
         """Checks that the set of files in corpus_dir exactly matches Documents. 
         Also checks that corpus document hashes match those in the database
         This is not included in QCCorpus.validate because it would create a 
         circular dependency: This method must be run from within a QCCorpus.session, 
         which cannot be instantiated until initialization is complete.
+
+        Files whose (size, mtime, inode) stat matches the stat recorded when the 
+        document's hash was last verified are not re-hashed unless full is True. 
         """
         q = select(Document)
         docs_in_db = set(self.get_session().scalars(q).all())
@@ -269,17 +408,26 @@ class QCCorpus:
                 f"{missing} is missing. Either restore the file or remove it from the " + 
                 f"project by running: qc corpus remove {missing}"
             )
+        docs_to_verify = []
         for doc in docs_in_db:
             path = self.corpus_dir / doc.file_path
             if path.exists():
-                if doc.file_hash != self.hash_file(path):
-                    errors.append(
-                        f"{doc.file_path} has been changed since it was imported. " + 
-                        f"This could affect the alignment of existing codes. " + 
-                        f"Either restore the original version of {doc.file_path}, or " + 
-                        f"import the changed version by running: qc corpus update " + 
-                        f"{doc.file_path}"
-                    )
+                stat = path.stat()
+                if full or not self.file_stat_matches(doc, stat):
+                    docs_to_verify.append((doc, path, stat))
+        hashes = self.hash_files([path for doc, path, stat in docs_to_verify])
+        for (doc, path, stat), file_hash in zip(docs_to_verify, hashes):
+            if doc.file_hash != file_hash:
+                errors.append(
+                    f"{doc.file_path} has been changed since it was imported. " + 
+                    f"This could affect the alignment of existing codes. " + 
+                    f"Either restore the original version of {doc.file_path}, or " + 
+                    f"import the changed version by running: qc corpus update " + 
+                    f"{doc.file_path}"
+                )
+            elif not self.is_query_only():
+                self.record_file_stat(doc, stat)
+        self.commit_cache()
         if errors:
             err = "Errors found in corpus:\n"
             fmt = lambda err: fill(err, initial_indent=" - ", subsequent_indent="   ")
@@ -320,6 +468,14 @@ class QCCorpus:
             self.get_session().commit()
             return coder
 
+    def create_coders(self, coder_names):
+        """Creates each coder in coder_names which does not already exist, using
+        a single statement. Does not commit the session.
+        """
+        if coder_names:
+            self.get_session().execute(insert(Coder).on_conflict_do_nothing(), 
+                    [{'name': name} for name in coder_names])
+
     # TODO once we implement migrations, this should be simplified using a 
     # delete cascade on the coder->coded_line
     def delete_coder(self, coder_name):
@@ -349,6 +505,14 @@ class QCCorpus:
             self.get_session().commit()
             return code
 
+    def create_codes(self, code_names):
+        """Creates each code in code_names which does not already exist, using
+        a single statement. Does not commit the session.
+        """
+        if code_names:
+            self.get_session().execute(insert(Code).on_conflict_do_nothing(), 
+                    [{'name': name} for name in code_names])
+
     def get_codes(self, pattern=None, file_list=None, coder=None):
         "Returns a list of all unique codes used in the corpus"
         query = select(Code.name).join(Code.coded_lines)
@@ -372,54 +536,121 @@ class QCCorpus:
     def get_paragraph(self, document, line, index_name="paragraphs"):
         """Gets the paragraph Location for the given document and the given line.
         """
+        location_id = self.get_paragraph_ids(document, [line], index_name=index_name)[0]
+        return self.get_session().get(Location, int(location_id))
+
+    def get_paragraph_ids(self, document, lines, index_name="paragraphs"):
+        """Returns an array of paragraph Location ids for each of the given lines 
+        in the document. Raises QCError if any line is not within a paragraph.
+        """
+        lookup = self.get_paragraph_lookup(document, index_name=index_name)
+        lines = np.asarray(lines, dtype=np.int64)
+        if len(lookup):
+            in_range = (lines >= 0) & (lines < len(lookup))
+            location_ids = np.where(in_range, lookup[np.clip(lines, 0, len(lookup) - 1)], -1)
+        else:
+            location_ids = np.full(len(lines), -1, dtype=np.int64)
+        if (location_ids < 0).any():
+            line = lines[np.argmax(location_ids < 0)]
+            raise QCError(f"Error getting paragraph for {document}, line {line}.")
+        return location_ids
+
+    def get_paragraph_lookup(self, document, index_name="paragraphs"):
+        """Returns an array mapping each line of the document to the id of the 
+        Location containing it (or -1). Lookups are cached for the duration of the 
+        session.
+        """
+        self.get_session()
+        key = (document, index_name)
+        if key not in self.paragraph_lookups:
+            paragraphs = self.get_paragraph_locations(document, index_name=index_name)
+            self.paragraph_lookups[key] = self.build_paragraph_lookup(paragraphs)
+        return self.paragraph_lookups[key]
+
+    def build_paragraph_lookup(self, paragraphs):
+        """Builds a line -> location id array from [(start_line, end_line, location_id)].
+        """
+        num_lines = max((end for start, end, location_id in paragraphs), default=0)
+        lookup = np.full(num_lines, -1, dtype=np.int64)
+        for start, end, location_id in paragraphs:
+            lookup[start:end] = location_id
+        return lookup
+
+    def clear_paragraph_lookups(self, document):
+        "Drops cached paragraph lookups for a document whose Locations have changed."
+        for key in [key for key in self.paragraph_lookups if key[0] == document]:
+            del self.paragraph_lookups[key]
+
+    def get_paragraph_locations(self, document, index_name="paragraphs"):
+        """Returns [(start_line, end_line, location_id)] for each paragraph Location in 
+        the given document, sorted by start_line.
+        """
         q = (
-            select(Location)
+            select(Location.start_line, Location.end_line, Location.id)
             .join(Location.document_index)
-            .join(DocumentIndex.document)
-            .where(Document.file_path == document)
+            .where(DocumentIndex.document_id == document)
             .where(DocumentIndex.name == index_name)
-            .where(Location.start_line <= line)
-            .where(Location.end_line > line)
+            .order_by(Location.start_line)
         )
-        try:
-            return self.get_session().execute(q).scalar_one()
-        except NoResultFound:
-            raise QCError(f"Error getting paragraph for {document}, line {line}.")
+        return [tuple(row) for row in self.get_session().execute(q).all()]
 
-    def update_coded_lines(self, document, coder, coded_line_data):
+    def update_coded_lines(self, document, coder, coded_line_data, commit=True):
         """Updates document's coded lines for the given coder.
         document and coder should be strings, and coded_line_data should
         be a list of dicts like {'line': 1, 'code_id': 'super'}.
 
         Fetches all existing coded lines for the document and coder, and 
         then compares the set of existing coded line data with new coded line data.
-        When existing are absent from new, marks objects for deletion. 
-        When new are absent from existing, creates a new CodedLine and adds it to the session.
+        Coded lines absent from new data are deleted, and new coded lines are inserted
+        in bulk, with each line resolved to its paragraph Location in memory. 
+        All changes are made in a single transaction. Then the codes which were 
+        applied are added to the codebook if it does not already contain them.
+        When commit is False, the session is not committed and the codebook is not
+        updated, so that many documents can be updated in one transaction.
         """
-        self.get_or_create_coder(coder)
-        for code_id in set(cl['code_id'] for cl in coded_line_data):
-            self.get_or_create_code(code_id)
         session = self.get_session()
-        q = (select(CodedLine)
+        new_coded_line_data = {(d['line'], d['code_id']) for d in coded_line_data}
+        code_names = set(code for line, code in new_coded_line_data)
+        existing_codes = set(session.scalars(select(Code.name).where(Code.name.in_(code_names))))
+        new_codes = code_names - existing_codes
+        session.execute(insert(Coder).values(name=coder).on_conflict_do_nothing())
+        if new_codes:
+            session.execute(insert(Code), [{'name': code} for code in new_codes])
+
+        q = (select(CodedLine.id, CodedLine.line, CodedLine.code_id)
             .join(CodedLine.locations)
             .join(Location.document_index)
             .where(DocumentIndex.document_id == document)
             .where(CodedLine.coder_id == coder)
         )
-        existing_coded_lines = self.session.scalars(q).all()
-        existing_coded_line_data = {(cl.line, cl.code_id) for cl in existing_coded_lines}
-        new_coded_line_data = {(d['line'], d['code_id']) for d in coded_line_data}
-        for cl in existing_coded_lines:
-            if (cl.line, cl.code_id) not in new_coded_line_data:
-                self.get_session().delete(cl)
-        for (line, code_id) in new_coded_line_data - existing_coded_line_data:
-            cl = CodedLine(line=line, code_id=code_id, coder_id=coder)
-            session.add(cl)
-            cl.locations.append(self.get_paragraph(document, line))
-        session.commit()
-        self.update_codebook()
-
-    def import_media(self, file_path, recursive=False, corpus_root=None, importer="pandoc"):
+        existing_coded_lines = session.execute(q).all()
+        existing_coded_line_data = {(line, code) for _, line, code in existing_coded_lines}
+        stale_ids = [cl_id for cl_id, line, code in existing_coded_lines 
+                if (line, code) not in new_coded_line_data]
+        for ids in chunked(stale_ids, self.batch_size):
+            session.execute(delete(coded_line_location_association_table)
+                    .where(coded_line_location_association_table.c.coded_line_id.in_(ids)))
+            session.execute(delete(CodedLine).where(CodedLine.id.in_(ids)),
+                    execution_options={"synchronize_session": False})
+
+        to_insert = sorted(new_coded_line_data - existing_coded_line_data)
+        if to_insert:
+            location_ids = self.get_paragraph_ids(document, [line for line, code in to_insert])
+            coded_line_ids = session.scalars(
+                insert(CodedLine).returning(CodedLine.id, sort_by_parameter_order=True),
+                [{'line': line, 'code_id': code, 'coder_id': coder} for line, code in to_insert],
+            ).all()
+            session.execute(insert(coded_line_location_association_table), [
+                {'coded_line_id': cl_id, 'location_id': location_id} 
+                for cl_id, location_id in zip(coded_line_ids, location_ids.tolist())
+            ])
+        if commit:
+            session.commit()
+            if code_names:
+                self.update_codebook(code_names)
+
+    def import_media(self, file_path, recursive=False, corpus_root=None, importer="pandoc",
+            jobs=1, progress=None):
         """Imports media into the corpus. 
         Importing media consists of three tasks: 
 
@@ -428,11 +659,11 @@ class QCCorpus:
         - and registering the file in the database. 
 
         The specified media importer handles transformation and saving. 
-        When recursive is True, walks the given directory and imports all files found.
+        When recursive is True, walks the given directory and imports all files found
+        (see import_media_files).
         When corpus_root is true, saves the files relative to the given subdirectory within
-        the corpus.
+        the corpus. progress is passed to import_media_files.
         """
-        imp = media_importers[importer](self.settings)
         source = Path(file_path)
 
         if not source.exists():
@@ -443,6 +674,8 @@ class QCCorpus:
             raise InvalidParameter(f"{source} is a dir. Use --recursive.")
         if corpus_root and Path(corpus_root).is_absolute():
             raise InvalidParameter(f"corpus_root ({corpus_root}) must be a relative path.")
+        if jobs < 1:
+            raise InvalidParameter(f"jobs ({jobs}) must be at least 1.")
 
         if corpus_root:
             dest_root_dir = self.corpus_dir / corpus_root
@@ -451,6 +684,7 @@ class QCCorpus:
             dest_root_dir = self.corpus_dir
 
         if recursive:
+            conversions = []
             for dir_path, dir_names, filenames in os.walk(source):
                 rel_dir_path = str(Path(dir_path).relative_to(source))
                 dest_dir = dest_root_dir / rel_dir_path
@@ -458,56 +692,314 @@ class QCCorpus:
                 for fn in filenames:
                     source_path = Path(dir_path) / fn
                     dest_path = (dest_dir / fn).with_suffix(".txt")
-                    imp.import_media(source_path, dest_path)
-                    self.register_document(dest_path)
+                    conversions.append((source_path, dest_path))
+            self.import_media_files(conversions, importer=importer, jobs=jobs, progress=progress)
         else:
             dest_path = (dest_root_dir / source.name).with_suffix(".txt")
-            imp.import_media(source, dest_path)
+            convert_media(importer, self.settings, source, dest_path)
             self.register_document(dest_path)
 
+    def import_media_files(self, conversions, importer="pandoc", jobs=1, progress=None):
+        """Converts and registers a list of (source_path, dest_path) files.
+        When jobs is greater than 1, conversions run in a pool of worker processes. 
+        Either way, converted files are registered by this process as they complete, 
+        committing once per batch. A file which fails to convert or register does 
+        not stop the import (and its output, if any, is removed from the corpus); errors 
+        are collected and raised as a single QCError once all other files have been 
+        imported. When progress is given, it is called as progress(completed, total) 
+        each time a file has been imported.
+        """
+        session = self.get_session()
+        errors = []
+        pending = 0
+        results = self.convert_media_files(conversions, importer=importer, jobs=jobs)
+        for completed, (source_path, dest_path, err) in enumerate(results, 1):
+            if err is None:
+                try:
+                    self.register_document(dest_path, commit=False)
+                    pending += 1
+                except Exception as register_err:
+                    err = register_err
+            if err is not None:
+                log.warning("Error importing media", source=str(source_path), error=str(err))
+                errors.append(f"{source_path}: {err}")
+                if dest_path.exists() and not self.get_document(dest_path):
+                    dest_path.unlink()
+            if pending >= self.batch_size:
+                session.commit()
+                pending = 0
+            if progress:
+                progress(completed, len(conversions))
+        session.commit()
+        if errors:
+            err = f"Errors importing {len(errors)} of {len(conversions)} files:\n"
+            fmt = lambda err: fill(err, initial_indent=" - ", subsequent_indent="   ")
+            raise QCError(err + '\n'.join(fmt(err) for err in errors))
+
+    def convert_media_files(self, conversions, importer="pandoc", jobs=1):
+        """Runs the importer on each (source_path, dest_path), yielding 
+        (source_path, dest_path, error) as conversions complete. error is None
+        when the conversion succeeded.
+        """
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                futures = {
+                    pool.submit(convert_media, importer, self.settings, source, dest): 
+                    (source, dest) for source, dest in conversions
+                }
+                for future in as_completed(futures):
+                    source, dest = futures[future]
+                    yield source, dest, future.exception()
+        else:
+            for source, dest in conversions:
+                try:
+                    convert_media(importer, self.settings, source, dest)
+                    yield source, dest, None
+                except Exception as err:
+                    yield source, dest, err
+
+    def file_stat_matches(self, doc, stat):
+        """Checks whether a file's stat matches the stat recorded for doc when its 
+        hash was last verified.
+        """
+        return (
+            doc.file_size is not None and
+            (doc.file_size, doc.file_mtime_ns, doc.file_inode) == 
+            (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        )
+
+    def record_file_stat(self, doc, stat):
+        """Records the stat of a file whose hash has just been verified. 
+        Files modified very recently are not recorded, because a further 
+        modification within the filesystem's timestamp resolution would not 
+        change the stat. Does not commit the session.
+        """
+        if (doc.file_size, doc.file_mtime_ns, doc.file_inode) != \
+                (stat.st_size, stat.st_mtime_ns, stat.st_ino):
+            doc.line_offsets = None
+        if time_ns() - stat.st_mtime_ns > self.racy_stat_window_ns:
+            doc.file_size = stat.st_size
+            doc.file_mtime_ns = stat.st_mtime_ns
+            doc.file_inode = stat.st_ino
+        else:
+            doc.file_size = doc.file_mtime_ns = doc.file_inode = None
+
+    def get_line_offsets(self, file_path, characters=False):
+        """Returns an array of the byte offset at which each line of a document 
+        ends, for use with DocumentReader. When characters is True, returns 
+        the character offset at which each line ends instead. file_path is the 
+        document's path within the corpus, as stored in the database.
+        Offsets are stored in the database and reused while the file's stat 
+        matches the stat recorded when its hash was last verified; otherwise 
+        they are computed from the file.
+        """
+        doc = self.get_session().get(Document, str(file_path))
+        stored = doc.line_offsets
+        offsets = self.document_line_offsets(doc, characters=characters)
+        if doc.line_offsets is not stored:
+            self.commit_cache()
+        return offsets
+
+    def document_line_offsets(self, doc, characters=False):
+        """Like get_line_offsets, but takes a Document, and does not commit the 
+        session when newly-computed offsets are stored. 
+        Offsets are stored as two rows: byte offsets and character offsets.
+        Nothing is stored when the database is query-only.
+        """
+        path = self.corpus_dir / doc.file_path
+        stat = path.stat()
+        if self.file_stat_matches(doc, stat) and doc.line_offsets is not None:
+            offsets = np.frombuffer(doc.line_offsets, dtype=np.int64).reshape(2, -1)
+        else:
+            with DocumentReader(path) as reader:
+                offsets = np.stack([reader.line_offsets, reader.character_offsets()])
+            if self.file_stat_matches(doc, stat) and not self.is_query_only():
+                doc.line_offsets = offsets.tobytes()
+        return offsets[1] if characters else offsets[0]
+
+    def get_cached_entities(self, file_hashes):
+        """Returns a dict mapping each of file_hashes which has cached named entities
+        to a list of (label, text) tuples.
+        """
+        cached = {}
+        for chunk in chunked(set(file_hashes), self.batch_size):
+            query = select(EntityCache).where(EntityCache.file_hash.in_(chunk))
+            for row in self.get_session().scalars(query):
+                cached[row.file_hash] = [tuple(ent) for ent in json.loads(row.entities)]
+        return cached
+
+    def cache_entities(self, file_hash, entities):
+        """Caches the named entities, a list of (label, text) tuples, found in the
+        text with file_hash. Nothing is cached when the database is query-only.
+        Does not commit.
+        """
+        if self.is_query_only():
+            return
+        self.get_session().merge(EntityCache(
+            file_hash=file_hash,
+            entities=json.dumps([list(ent) for ent in entities]),
+        ))
+
     def hash_file(self, corpus_path):
         """Computes the hash of a document at a corpus path.
+        The file is read in chunks, so memory use does not grow with file size.
         """
-        return sha1(Path(corpus_path).read_bytes()).hexdigest()
+        with open(corpus_path, 'rb') as fh:
+            return file_digest(fh, sha1).hexdigest()
 
-    def register_document(self, corpus_path):
+    def hash_files(self, corpus_paths, jobs=None):
+        """Computes the hashes of many files, using a pool of threads.
+        hashlib releases the GIL while hashing, so this is limited by disk
+        bandwidth rather than by a single core.
+        """
+        if len(corpus_paths) < 2:
+            return [self.hash_file(path) for path in corpus_paths]
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(self.hash_file, corpus_paths))
+
+    def register_document(self, corpus_path, commit=True):
         """Adds database entries for a document.
-        Document contents are stored in files under the corpus_dir
+        Document contents are stored in files under the corpus_dir.
+        Also caches the document's line -> paragraph lookup for the session.
+        The document is read before anything is added to the session, so a 
+        failure leaves the session unchanged. When commit is False, the session
+        is not committed.
         """
         doc = self.get_document(corpus_path)
         if doc:
             raise Document.AlreadyExists(doc)
         relpath = self.get_corpus_path(corpus_path)
+        stat = Path(corpus_path).stat()
+        file_hash = self.hash_file(corpus_path)
+        with open(corpus_path) as fh:
+            paragraphs = list(iter_paragraph_lines(fh))
         document = Document(
             file_path=str(relpath),
-            file_hash=self.hash_file(corpus_path),
+            file_hash=file_hash,
         )
+        self.record_file_stat(document, stat)
         self.get_session().add(document)
         index = DocumentIndex(
             name="paragraphs",
             document=document,
         )
         self.get_session().add(index)
-        with open(corpus_path) as fh:
-            for p_start, p_end in iter_paragraph_lines(fh):
-                self.get_session().add(Location(
-                    start_line=p_start, 
-                    end_line=p_end,
-                    document_index=index,
-                ))
-        self.get_session().commit()
+        locations = []
+        for p_start, p_end in paragraphs:
+            locations.append(Location(
+                start_line=p_start, 
+                end_line=p_end,
+                document_index=index,
+            ))
+        self.get_session().add_all(locations)
+        self.get_session().flush()
+        self.paragraph_lookups[(str(relpath), index.name)] = self.build_paragraph_lookup(
+            [(loc.start_line, loc.end_line, loc.id) for loc in locations]
+        )
+        if commit:
+            self.get_session().commit()
 
     def get_updated_coded_lines(self, file_path, diff):
         """Returns [(code, coder, line, file_path)] after applying a file diff.
         When a document is updated, its line numbers may change and consequently
         existing paragraphs and existing coded lines may need to be re-indexed.
+        Coded lines on deleted lines are omitted.
+        """
+        corpus_path = str(self.get_corpus_path(file_path))
+        return reindex_coded_lines(self.iter_coded_lines(file_list=[corpus_path]), diff)
+
+    def reindex_document(self, corpus_path, diff, text_path, index_name="paragraphs"):
+        """Reindexes a document after its text has changed. diff is a unified diff
+        from the old version of the document to the new version, whose text is at 
+        text_path. 
+        Line numbers are mapped in bulk (see diff.get_line_mapping): each coded line
+        is moved to its new line number, and coded lines on deleted lines are deleted.
+        The document's paragraph Locations are rebuilt from the new text. Paragraphs
+        which map exactly onto a paragraph of the new text keep their Location (with
+        updated line numbers), so only coded lines in changed paragraphs need to be 
+        associated with new Locations. Does not commit the session.
         """
-        corpus_path = self.get_corpus_path(file_path)
-        coded_lines = self.get_coded_lines(file_list=[corpus_path])
-        log.debug(coded_lines)
-        # Get all existing coded lines. 
-        # Iterate through the diff
-        # return a list of updated coded lines.
+        session = self.get_session()
+        association = coded_line_location_association_table
+        map_lines = get_line_mapping(read_diff_offsets(diff))
+        index_id = session.scalars(select(DocumentIndex.id)
+            .where(DocumentIndex.document_id == corpus_path)
+            .where(DocumentIndex.name == index_name)
+        ).one()
+        rows = session.execute(select(CodedLine.id, CodedLine.line, association.c.location_id)
+            .join(association, association.c.coded_line_id == CodedLine.id)
+            .join(Location, Location.id == association.c.location_id)
+            .where(Location.document_index_id == index_id)
+        ).all()
+        ids, lines, location_ids = np.array([tuple(row) for row in rows], 
+                dtype=np.int64).reshape(-1, 3).T
+        new_lines = map_lines(lines)
+
+        old_paragraphs = np.array(self.get_paragraph_locations(corpus_path, index_name), 
+                dtype=np.int64).reshape(-1, 3)
+        starts, ends, old_ids = old_paragraphs.T
+        new_starts, new_lasts = map_lines(starts), map_lines(ends - 1)
+        with open(text_path) as fh:
+            new_paragraphs = {start: end for start, end in iter_paragraph_lines(fh)}
+        kept_paragraphs = {}
+        for old_id, start, last in zip(old_ids.tolist(), new_starts.tolist(), new_lasts.tolist()):
+            if start >= 0 and last >= 0 and new_paragraphs.get(start) == last + 1:
+                kept_paragraphs[old_id] = start
+        dropped_ids = [old_id for old_id in old_ids.tolist() if old_id not in kept_paragraphs]
+
+        deleted = new_lines < 0
+        stale_ids = ids[deleted | ~np.isin(location_ids, list(kept_paragraphs))].tolist()
+        for chunk in chunked(stale_ids, self.batch_size):
+            session.execute(delete(association).where(association.c.coded_line_id.in_(chunk)))
+        for chunk in chunked(ids[deleted].tolist(), self.batch_size):
+            session.execute(delete(CodedLine).where(CodedLine.id.in_(chunk)),
+                    execution_options={"synchronize_session": False})
+        for chunk in chunked(dropped_ids, self.batch_size):
+            session.execute(delete(Location).where(Location.id.in_(chunk)),
+                    execution_options={"synchronize_session": False})
+        moved = ~deleted & (new_lines != lines)
+        if moved.any():
+            # Passed straight to the driver's executemany: for a long document, 
+            # SQLAlchemy's per-row parameter handling would dominate.
+            session.connection().exec_driver_sql(
+                f"UPDATE {CodedLine.__tablename__} SET line = ?2 WHERE id = ?1",
+                sorted(zip(ids[moved].tolist(), new_lines[moved].tolist()))
+            )
+        old_bounds = dict(zip(old_ids.tolist(), zip(starts.tolist(), ends.tolist())))
+        moved_paragraphs = [
+            {'id': old_id, 'start_line': start, 'end_line': new_paragraphs[start]}
+            for old_id, start in kept_paragraphs.items()
+            if old_bounds[old_id] != (start, new_paragraphs[start])
+        ]
+        if moved_paragraphs:
+            session.execute(update(Location), moved_paragraphs)
+        kept_starts = set(kept_paragraphs.values())
+        added_paragraphs = [(start, end) for start, end in new_paragraphs.items() 
+                if start not in kept_starts]
+        added_ids = []
+        if added_paragraphs:
+            added_ids = session.scalars(
+                insert(Location).returning(Location.id, sort_by_parameter_order=True), [
+                    {'start_line': start, 'end_line': end, 'document_index_id': index_id}
+                    for start, end in added_paragraphs
+                ]
+            ).all()
+        self.clear_paragraph_lookups(corpus_path)
+        self.paragraph_lookups[(corpus_path, index_name)] = self.build_paragraph_lookup(
+            [(start, new_paragraphs[start], old_id) for old_id, start in kept_paragraphs.items()] + 
+            [(start, end, loc_id) for (start, end), loc_id in zip(added_paragraphs, added_ids)]
+        )
+        relocated = ~deleted & ~np.isin(location_ids, list(kept_paragraphs))
+        if relocated.any():
+            paragraph_ids = self.get_paragraph_ids(corpus_path, new_lines[relocated], 
+                    index_name=index_name)
+            session.execute(insert(association), [
+                {'coded_line_id': cl_id, 'location_id': location_id}
+                for cl_id, location_id in zip(ids[relocated].tolist(), paragraph_ids.tolist())
+            ])
+        log.info("Reindexed document", document=corpus_path, coded_lines=len(ids),
+                moved=int(moved.sum()), deleted=int(deleted.sum()), 
+                relocated=int(relocated.sum()))
 
     def count_codes(self, pattern=None, file_list=None, coders=None, unit="line"):
         """Returns a dict of {code:count}.
@@ -533,6 +1025,23 @@ class QCCorpus:
             query = query.where(Document.file_path.in_(file_list))
         return self.get_session().scalars(query).all()
 
+    def iter_documents(self, pattern=None, file_list=None, line_offsets=False, 
+            batch_size=None):
+        """Yields matching Document objects ordered by file path, fetching them 
+        from the database in batches. When line_offsets is True, stored line 
+        offsets are loaded with the documents, so that document_line_offsets does not 
+        need to query the database.
+        """
+        query = select(Document).order_by(Document.file_path)
+        if pattern:
+            query = query.where(Document.file_path.contains(pattern))
+        if file_list:
+            query = query.where(Document.file_path.in_(file_list))
+        if line_offsets:
+            query = query.options(undefer(Document.line_offsets))
+        query = query.execution_options(yield_per=batch_size or self.batch_size)
+        yield from self.get_session().scalars(query)
+
     def move_document(self, target, destination, recursive=False):
         """Move a file from target to destination, updating the database.
         """
@@ -564,6 +1073,7 @@ class QCCorpus:
         to match. Does not commit the session.
         """
         doc = self.get_documents(file_list=[str(old_file_path)])[0]
+        self.clear_paragraph_lookups(str(old_file_path))
         for document_index in doc.indices:
             document_index.document_id = str(new_file_path)
         doc.file_path = str(new_file_path)
@@ -634,15 +1144,17 @@ class QCCorpus:
         for cl in coded_lines:
             session.delete(cl)
         doc = self.get_documents(file_list=[file_path])[0]
+        self.clear_paragraph_lookups(file_path)
         session.delete(doc)
 
     def filter_query_by_document(self, query, pattern=None, file_list=None, 
-            unit="line"):
+            unit="line", join_index=False):
         """Filters a query by which documents match. 
         When unit is paragraph or document, ensures that the query is joined to needed
         tables regardless of whether pattern or file_list are provided.
+        When join_index is True, the query is always joined to DocumentIndex.
         """
-        if pattern or file_list or unit == "paragraph" or unit == "document":
+        if pattern or file_list or join_index or unit == "paragraph" or unit == "document":
             query = query.join(CodedLine.locations).join(Location.document_index)
         if pattern or file_list or unit == "document":
             query = query.join(DocumentIndex.document)
@@ -676,6 +1188,19 @@ class QCCorpus:
     def get_coded_lines(self, codes=None, pattern=None, file_list=None, coders=None):
         """Returns [(code, coder, line, file_path)]
         """
+        query = self.coded_lines_query(codes, pattern, file_list, coders)
+        return self.get_session().execute(query).all()
+
+    def iter_coded_lines(self, codes=None, pattern=None, file_list=None, coders=None,
+            batch_size=None):
+        """Like get_coded_lines, but yields (code, coder, line, file_path) tuples,
+        fetching rows from the database in batches.
+        """
+        query = self.coded_lines_query(codes, pattern, file_list, coders)
+        return self.iter_rows(query, batch_size=batch_size)
+
+    def coded_lines_query(self, codes=None, pattern=None, file_list=None, coders=None):
+        "Returns the query for get_coded_lines and iter_coded_lines"
         query = (
             select(
                 CodedLine.code_id, 
@@ -691,13 +1216,25 @@ class QCCorpus:
         if codes:
             query = query.where(CodedLine.code_id.in_(codes))
         query = self.filter_query_by_document(query, pattern, file_list)
-        query = self.filter_query_by_coders(query, coders)
-        return self.get_session().execute(query).all()
+        return self.filter_query_by_coders(query, coders)
 
     def get_coded_paragraphs(self, codes=None, pattern=None, file_list=None, coders=None):
-        """Returns (Code.name, Coder.name, CodedLine.line_number, Document.file_path, Location.id,
-                Location.start_line, Location.end_line)
+        """Returns (Code.name, Coder.name, Document.file_path, Location.start_line, 
+                Location.end_line)
+        """
+        query = self.coded_paragraphs_query(codes, pattern, file_list, coders)
+        return self.get_session().execute(query).all()
+
+    def iter_coded_paragraphs(self, codes=None, pattern=None, file_list=None, coders=None,
+            batch_size=None):
+        """Like get_coded_paragraphs, but yields tuples, fetching rows from the
+        database in batches.
         """
+        query = self.coded_paragraphs_query(codes, pattern, file_list, coders)
+        return self.iter_rows(query, batch_size=batch_size)
+
+    def coded_paragraphs_query(self, codes=None, pattern=None, file_list=None, coders=None):
+        "Returns the query for get_coded_paragraphs and iter_coded_paragraphs"
         query = (
             select(CodedLine.code_id, CodedLine.coder_id, DocumentIndex.document_id,
                    Location.start_line, Location.end_line)
@@ -709,12 +1246,24 @@ class QCCorpus:
         if codes:
             query = query.where(CodedLine.code_id.in_(codes))
         query = self.filter_query_by_document(query, pattern, file_list)
-        query = self.filter_query_by_coders(query, coders)
-        return self.get_session().execute(query).all()
+        return self.filter_query_by_coders(query, coders)
 
     def get_coded_documents(self, codes=None, pattern=None, file_list=None, coders=None):
         """Returns (Code.name, Coder.name, Document.file_path)
         """
+        query = self.coded_documents_query(codes, pattern, file_list, coders)
+        return self.get_session().execute(query).all()
+
+    def iter_coded_documents(self, codes=None, pattern=None, file_list=None, coders=None,
+            batch_size=None):
+        """Like get_coded_documents, but yields tuples, fetching rows from the
+        database in batches.
+        """
+        query = self.coded_documents_query(codes, pattern, file_list, coders)
+        return self.iter_rows(query, batch_size=batch_size)
+
+    def coded_documents_query(self, codes=None, pattern=None, file_list=None, coders=None):
+        "Returns the query for get_coded_documents and iter_coded_documents"
         query = (
             select(CodedLine.code_id, CodedLine.coder_id, DocumentIndex.document_id)
             .join(CodedLine.locations)
@@ -725,8 +1274,16 @@ class QCCorpus:
         if codes:
             query = query.where(CodedLine.code_id.in_(codes))
         query = self.filter_query_by_document(query, pattern, file_list)
-        query = self.filter_query_by_coders(query, coders)
-        return self.get_session().execute(query).all()
+        return self.filter_query_by_coders(query, coders)
+
+    def iter_rows(self, query, batch_size=None):
+        """Executes query, yielding rows as plain tuples. Rows are fetched 
+        batch_size (by default, self.batch_size) at a time, so memory use does 
+        not grow with the number of rows. 
+        """
+        query = query.execution_options(yield_per=batch_size or self.batch_size)
+        for rows in self.get_session().execute(query).partitions():
+            yield from map(tuple, rows)
 
     def get_code_matrix(self, codes, 
         recursive_codes=False,
@@ -743,57 +1300,93 @@ class QCCorpus:
         Each code represents its code set, consisting of itself and 
         matching child codes, if `recursive_codes` is set. 
         Selections are each unit within each matching corpus file.
+        Two code sets co-occur in a unit (line, paragraph, or document) when both
+        were applied anywhere within it, and each entry counts distinct units,
+        however many coders applied the codes. The diagonal therefore counts the 
+        units in which each code set was applied.
         """
-        tree = self.get_codebook()
-        if codes:
-            nodes = sum([tree.find(c) for c in codes], [])
-            if recursive_codes:
-                nodes = set(sum([n.flatten(depth=depth) for n in nodes], []))
-        else:
-            nodes = tree.flatten(depth=depth)
+        tree = self.get_codebook().index()
+        nodes = tree.select(codes, recursive_codes=recursive_codes, depth=depth)
         node_names = set([n.name for n in nodes])
         if recursive_counts:
-            code_sets = [(n.name, set(n.flatten(names=True))) for n in nodes]
+            code_sets = [(n.name, set(tree.flatten(n, names=True))) for n in nodes]
         else:
             code_sets = [(n.name, set([n.name])) for n in nodes]
 
-        CodedLineA = aliased(CodedLine)
-        CodedLineB = aliased(CodedLine)
-        LocationA = aliased(Location)
-        LocationB = aliased(Location)
-        unit_column = self.get_column_to_count(unit, coded_line_alias=CodedLineA,
-            location_alias=LocationA)
-        cooccurrences = np.zeros((len(nodes), len(nodes)), dtype=int)
-        combos = combinations_with_replacement(enumerate(code_sets), 2)
-        for (ix_a, (c_a, cs_a)), (ix_b, (c_b, cs_b)) in combos:
-            query = (
-                select(func.count(distinct(unit_column)))
-                .where(CodedLineA.code_id.in_(cs_a))
-                .where(CodedLineB.code_id.in_(cs_b))
-                .where(CodedLineA.line == CodedLineB.line)
-                .join(LocationA, CodedLineA.locations)
-                .join(LocationB, CodedLineB.locations)
-                .where(LocationA.document_index_id == LocationB.document_index_id)
-            )
-            query = self.filter_query_by_coders(query, coders, CodedLineA)
-            query = self.filter_query_by_coders(query, coders, CodedLineB)
-
-            ab_count = self.get_session().scalars(query).first()
-            cooccurrences[ix_a][ix_b] = ab_count
-            cooccurrences[ix_b][ix_a] = ab_count
-
+        set_indices_by_code = defaultdict(list)
+        for ix, (name, code_set) in enumerate(code_sets):
+            for code in code_set:
+                set_indices_by_code[code].append(ix)
+        incidence = self.get_code_incidence(
+            codes=set_indices_by_code.keys(),
+            unit=unit,
+            pattern=pattern,
+            file_list=file_list,
+            coders=coders,
+        )
+        unit_indices = {}
+        rows, cols = [], []
+        for unit_key, code in incidence:
+            row = unit_indices.setdefault(unit_key, len(unit_indices))
+            for ix in set_indices_by_code[code]:
+                rows.append(row)
+                cols.append(ix)
+        cooccurrences = self.cooccurrence_matrix(rows, cols, len(unit_indices), len(nodes))
         labels = [n.expanded_name() if expanded else n.name for n in nodes] 
         return labels, cooccurrences
 
-    def update_codebook(self):
+    def get_code_incidence(self, codes=None, unit='line', pattern=None, file_list=None,
+            coders=None):
+        """Returns a set of (unit, code) pairs, one for each unit in which a code was used. 
+        Units are (file_path, line) for lines, (file_path, start_line) for paragraphs,
+        and file_path for documents.
+        """
+        codes = list(codes) if codes is not None else None
+        if unit == "line":
+            coded_lines = self.get_coded_lines(codes=codes, pattern=pattern, 
+                    file_list=file_list, coders=coders)
+            return set(((doc, line), code) for code, coder, line, doc in coded_lines)
+        elif unit == "paragraph":
+            coded_paragraphs = self.get_coded_paragraphs(codes=codes, pattern=pattern, 
+                    file_list=file_list, coders=coders)
+            return set(((doc, start), code) for code, coder, doc, start, end in coded_paragraphs)
+        elif unit == "document":
+            coded_documents = self.get_coded_documents(codes=codes, pattern=pattern, 
+                    file_list=file_list, coders=coders)
+            return set((doc, code) for code, coder, doc in coded_documents)
+        else:
+            raise InvalidParameter(f"Unit must be one of {', '.join(self.units)}")
+
+    def cooccurrence_matrix(self, rows, cols, num_units, num_codes, chunk_size=10000):
+        """Computes X.T @ X for the sparse (units * codes) incidence matrix X, 
+        given as coordinate arrays of rows and cols. Units are densified 
+        chunk_size rows at a time so that memory stays bounded on large corpora.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        order = np.argsort(rows, kind="stable")
+        rows, cols = rows[order], cols[order]
+        cooccurrences = np.zeros((num_codes, num_codes), dtype=int)
+        for start in range(0, num_units, chunk_size):
+            lo, hi = np.searchsorted(rows, [start, start + chunk_size])
+            X = np.zeros((min(chunk_size, num_units - start), num_codes), dtype=np.float32)
+            X[rows[lo:hi] - start, cols[lo:hi]] = 1
+            cooccurrences += np.rint(X.T @ X).astype(int)
+        return cooccurrences
+
+    def update_codebook(self, codes=None):
         """
         Updates the codebook by adding any new codes used in the codefiles.
         Does not remove unused codes.
+        When codes is given, only those codes are checked, instead of every code 
+        used in the corpus. The codebook is only rewritten when codes are added.
         """
-        all_codes = self.get_codes()
+        codes = self.get_codes() if codes is None else set(codes)
         code_tree = self.get_codebook()
-        new_codes = all_codes - set(code_tree.flatten(names=True))
-        for new_code in new_codes:
+        new_codes = codes - set(code_tree.flatten(names=True))
+        if not new_codes:
+            return
+        for new_code in sorted(new_codes):
             code_tree.add_child(new_code)
         TreeNode.write_yaml(self.codebook_path, code_tree)
 
@@ -801,27 +1394,61 @@ class QCCorpus:
         """
         Updates the codefiles and the codebook, replacing the old code with the new code. 
         Removes the old code from the codebook.
+
+        The rename is set-based: a matching coded line is deleted rather than renamed
+        when the same coder has already applied the new code to the same line of the 
+        same document (or when another matching coded line will be renamed there). 
+        These duplicates are found with a single query, which ranks matching and 
+        existing coded lines within each (coder, document, line), existing lines first.
+        The remaining matching coded lines are updated in bulk.
         """
         session = self.get_session()
         new_code = self.get_or_create_code(new_code)
         query = (
-            select(CodedLine)
+            select(
+                CodedLine.id, 
+                CodedLine.coder_id, 
+                CodedLine.line, 
+                DocumentIndex.document_id
+            )
+            .where(CodedLine.code_id.in_(old_codes))
+        )
+        query = self.filter_query_by_document(query, pattern, file_list, unit="paragraph")
+        query = self.filter_query_by_coders(query, coders)
+        existing = (
+            select(CodedLine.id, CodedLine.coder_id, CodedLine.line, DocumentIndex.document_id)
             .join(CodedLine.locations)
             .join(Location.document_index)
             .where(DocumentIndex.name == "paragraphs")
-            .where(CodedLine.code_id.in_(old_codes))
+            .where(CodedLine.code_id == new_code.name)
+            .where(CodedLine.code_id.not_in(old_codes))
         )
-        query = self.filter_query_by_document(query, pattern, file_list)
-        query = self.filter_query_by_coders(query, coders)
-        matching_coded_lines = session.execute(query).scalars()
-        for cl in matching_coded_lines:
-            doc_path = cl.locations[0].document_index.document_id
-            if self.coded_line_exists(cl.coder_id, new_code.name, cl.line, doc_path):
-                session.delete(cl)
-            else:
-                cl.code = new_code
+        candidates = union_all(
+            query.add_columns(literal(1).label("renamed")),
+            existing.add_columns(literal(0).label("renamed")),
+        ).subquery()
+        rank = func.row_number().over(
+            partition_by=(candidates.c.coder_id, candidates.c.document_id, candidates.c.line),
+            order_by=(candidates.c.renamed, candidates.c.id),
+        )
+        ranked = select(candidates.c.id, candidates.c.renamed, rank.label("rank")).subquery()
+        rows = session.execute(
+            select(ranked.c.id, ranked.c.rank > 1).where(ranked.c.renamed == 1)
+        ).all()
+        duplicate_ids = [cl_id for cl_id, duplicate in rows if duplicate]
+        rename_ids = [cl_id for cl_id, duplicate in rows if not duplicate]
+        for ids in chunked(duplicate_ids, self.batch_size):
+            session.execute(delete(coded_line_location_association_table)
+                    .where(coded_line_location_association_table.c.coded_line_id.in_(ids)))
+            session.execute(delete(CodedLine).where(CodedLine.id.in_(ids)),
+                    execution_options={"synchronize_session": False})
+        for ids in chunked(rename_ids, self.batch_size):
+            session.execute(update(CodedLine)
+                    .where(CodedLine.id.in_(ids))
+                    .values(code_id=new_code.name),
+                    execution_options={"synchronize_session": False})
         session.commit()
-        self.update_codebook()
+        self.update_codebook([new_code.name])
 
     def coded_line_exists(self, coder_name, code_name, line, document_file_path):
         """Checks whether a coded line exists with the given params.
@@ -845,53 +1472,74 @@ class QCCorpus:
         """Counts codes per-coder. Returns a dict of dicts like {"coder":{"code": n}}.
         """
         coders = coders or [c.name for c in self.get_all_coders()]
-        attr = "total" if totals else "count"
-        totals_by_coder = defaultdict(lambda: defaultdict(int))
-        for coder in coders:
-            tree = self.get_code_tree_with_counts(
-                pattern=pattern, 
-                file_list=file_list,
-                coders=[coder], 
-                unit=unit, 
-            )
-            if codes:
-                nodes = sum([tree.find(c) for c in codes], [])
-                if recursive_codes:
-                    nodes = set(sum([n.flatten(depth=depth) for n in nodes], []))
-            else:
-                nodes = tree.flatten(depth=depth)
-            for node in nodes:
-                totals_by_coder[coder][node.expanded_name()] = getattr(node, attr)
-        return totals_by_coder
+        return self.count_codes_by_group(
+            CodedLine.coder_id,
+            coders,
+            codes=codes,
+            coders=coders,
+            recursive_codes=recursive_codes,
+            depth=depth,
+            pattern=pattern,
+            file_list=file_list,
+            unit=unit,
+            totals=totals,
+        )
 
     def count_codes_by_document(self, codes=None, coders=None, recursive_codes=False,
             depth=None, pattern=None, file_list=None, unit='line', totals=True):
-        """Counts codes per-coder. Returns a dict of dicts like {"coder":{"code": n}}.
+        """Counts codes per-document. Returns a dict of dicts like {"document":{"code": n}}.
         """
         documents = self.get_documents(pattern=pattern, file_list=file_list)
-        documents = [doc.file_path for doc in documents]
-        attr = "total" if totals else "count"
-        totals_by_doc = defaultdict(lambda: defaultdict(int))
-        for doc in documents:
-            tree = self.get_code_tree_with_counts(
-                file_list=[doc],
-                coders=coders, 
-                unit=unit, 
-            )
-            if codes:
-                nodes = sum([tree.find(c) for c in codes], [])
-                if recursive_codes:
-                    nodes = set(sum([n.flatten(depth=depth) for n in nodes], []))
-            else:
-                nodes = tree.flatten(depth=depth)
-            for node in nodes:
-                totals_by_doc[doc][node.expanded_name()] = getattr(node, attr)
-        return totals_by_doc
+        return self.count_codes_by_group(
+            DocumentIndex.document_id,
+            [doc.file_path for doc in documents],
+            codes=codes,
+            coders=coders,
+            recursive_codes=recursive_codes,
+            depth=depth,
+            pattern=pattern,
+            file_list=file_list,
+            unit=unit,
+            totals=totals,
+        )
+
+    def count_codes_by_group(self, group_column, groups, codes=None, coders=None, 
+            recursive_codes=False, depth=None, pattern=None, file_list=None, unit='line', 
+            totals=True):
+        """Counts codes for each value of group_column, using a single grouped query.
+        Returns a dict of dicts like {"group":{"code": n}}, keyed by expanded code names. 
+        Counts are rolled up the codebook in memory: when totals is True, each code's 
+        count includes the counts of its descendants.
+        """
+        unit_column = self.get_column_to_count(unit)
+        query = (
+            select(group_column, CodedLine.code_id, func.count(distinct(unit_column)))
+            .group_by(group_column, CodedLine.code_id)
+        )
+        query = self.filter_query_by_document(query, pattern, file_list, unit=unit,
+                join_index=True)
+        query = self.filter_query_by_coders(query, coders)
+        result = self.get_session().execute(query).all()
+
+        tree = self.get_codebook().index()
+        nodes = tree.select(codes, recursive_codes=recursive_codes, depth=depth)
+        contributions = defaultdict(list)
+        for expanded_name, node in {n.expanded_name(): n for n in nodes}.items():
+            for code in (tree.flatten(node, names=True) if totals else [node.name]):
+                contributions[code].append(expanded_name)
+
+        counts_by_group = defaultdict(lambda: defaultdict(int))
+        counts_by_group.update((group, defaultdict(int)) for group in groups)
+        for group, code, count in result:
+            for expanded_name in contributions[code]:
+                counts_by_group[group][expanded_name] += count
+        return counts_by_group
 
     def update_document(self, file_path, new, dryrun=False):
         """Update the text of a corpus document. 
         In addition to updating the text in the file, the hash in the database
         needs to be updated and all existing coded lines need to be reindexed. 
+        All database changes are made in a single transaction.
         """
         if new:
             log.debug("Using new file comparison diff strategy")
@@ -908,19 +1556,97 @@ class QCCorpus:
             print(diff)
         else:
             corpus_path = str(self.get_corpus_path(file_path))
-            coded_lines = self.get_coded_lines(file_list=[corpus_path])
-            reindexed_coded_lines = reindex_coded_lines(coded_lines, diff)
-            coded_lines_by_file_by_coder = defaultdict(lambda: defaultdict(list))
-            for code, coder, line, file_path in reindexed_coded_lines:
-                coded_lines_by_file_by_coder[file_path][coder].append({
-                    'line': line, 
-                    'code_id': code,
-                })
-            for file_path, lines_by_coder in coded_lines_by_file_by_coder.items():
-                for coder, lines in lines_by_coder.items():
-                    self.update_coded_lines(file_path, coder, lines)
+            updated = self._update_document(corpus_path, diff, new)
+            try:
+                self.get_session().commit()
+                if updated:
+                    os.replace(updated, self.corpus_dir / corpus_path)
+            finally:
+                if updated:
+                    updated.unlink(missing_ok=True)
+
+    def update_documents(self, new_dir=None, git_range=None, dryrun=False, jobs=1):
+        """Updates many corpus documents at once, from either a directory of new
+        versions (new_dir, laid out like the corpus directory) or a git revision 
+        range (git_range), in which case the current corpus files are the new versions. 
+        Diffs are computed by a single `git diff`, or with difflib in jobs worker 
+        processes. All documents are reindexed in a single transaction.
+        """
+        if (new_dir is None) == (git_range is None):
+            raise InvalidParameter("Exactly one of new_dir and git_range is required.")
+        if jobs < 1:
+            raise InvalidParameter(f"jobs ({jobs}) must be at least 1.")
+        registered = set(self.get_session().scalars(select(Document.file_path)))
+        if new_dir is not None:
+            log.debug("Using new directory comparison diff strategy")
+            new_dir = Path(new_dir)
+            if not new_dir.is_dir():
+                raise InvalidParameter(f"new directory {new_dir} does not exist")
+            new_paths = {
+                str(path.relative_to(new_dir)): path 
+                for path in sorted(new_dir.rglob("*")) if path.is_file()
+            }
+            unknown = sorted(set(new_paths) - registered)
+            if unknown:
+                raise QCError(f"Files in {new_dir} are not in the corpus: {', '.join(unknown)}")
+            pairs = [(self.corpus_dir / corpus_path, path) for corpus_path, path in new_paths.items()]
+            diffs = dict(zip(new_paths, get_diffs(pairs, jobs=jobs)))
+        else:
+            log.debug("Using git range diff strategy", git_range=git_range)
+            try:
+                file_diffs = get_git_range_diffs(git_range, self.corpus_dir)
+            except (ValueError, OSError) as err:
+                raise QCError(f"Could not get git diff for {git_range}: {err}")
+            new_paths, diffs = {}, {}
+            for old_path, new_path, diff in file_diffs:
+                if old_path is None:
+                    log.warning("Skipping file added in the git range", file_path=new_path)
+                elif new_path is None:
+                    log.warning("Skipping deleted document", file_path=old_path)
+                elif new_path not in registered:
+                    log.warning("Skipping file which is not in the corpus", file_path=new_path)
+                else:
+                    diffs[new_path] = diff
+        diffs = {corpus_path: diff for corpus_path, diff in diffs.items() if diff}
+
+        if dryrun:
+            for diff in diffs.values():
+                print(diff)
+        else:
+            replacements = []
+            try:
+                for corpus_path, diff in diffs.items():
+                    updated = self._update_document(corpus_path, diff, new_paths.get(corpus_path))
+                    if updated:
+                        replacements.append((updated, self.corpus_dir / corpus_path))
+                self.get_session().commit()
+                for updated, path in replacements:
+                    os.replace(updated, path)
+            finally:
+                for updated, path in replacements:
+                    updated.unlink(missing_ok=True)
+            log.info("Updated documents", documents=len(diffs))
+
+    def _update_document(self, corpus_path, diff, new=None):
+        """Reindexes a document using diff, and updates the document's hash and stat
+        to match the new version. Does not commit. When new is given, its text is 
+        written to a temporary file next to the document, which is returned so that 
+        it can replace the document once the transaction is committed. Renaming 
+        keeps the temporary file's stat, so the recorded stat stays valid.
+        """
+        path = self.corpus_dir / corpus_path
+        self.reindex_document(corpus_path, diff, new or path)
+        doc = self.get_document(path)
+        if new:
+            updated = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+            updated.write_text(Path(new).read_text())
+        else:
+            updated = path
+        try:
+            doc.file_hash = self.hash_file(updated)
+            self.record_file_stat(doc, updated.stat())
+        except BaseException:
             if new:
-                (self.corpus_dir / corpus_path).write_text(Path(new).read_text())
-            doc = self.get_document(self.corpus_dir / corpus_path)
-            doc.file_hash = self.hash_file(self.corpus_dir / corpus_path)
-            self.get_session().commit()
+                updated.unlink(missing_ok=True)
+            raise
+        return updated if new else None
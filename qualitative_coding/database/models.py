@@ -1,10 +1,11 @@
-from typing import List
+from typing import List, Optional
 from sqlalchemy import (
     ForeignKey,
     UniqueConstraint,
     CheckConstraint,
     Table,
     Column,
+    Index,
 )
 from sqlalchemy.orm import (
     DeclarativeBase,
@@ -21,6 +22,10 @@ class Document(Base):
     __tablename__ = "document"
     file_path: Mapped[str] = mapped_column(primary_key=True)
     file_hash: Mapped[str] 
+    file_size: Mapped[Optional[int]]
+    file_mtime_ns: Mapped[Optional[int]]
+    file_inode: Mapped[Optional[int]]
+    line_offsets: Mapped[Optional[bytes]] = mapped_column(deferred=True)
     indices: Mapped[List["DocumentIndex"]] = relationship(back_populates="document",
             cascade="all, delete-orphan")
 
@@ -51,12 +56,15 @@ coded_line_location_association_table = Table(
     Base.metadata,
     Column("coded_line_id", ForeignKey("coded_line.id"), primary_key=True),
     Column("location_id", ForeignKey("location.id"), primary_key=True),
+    Index("ix_coded_line_location_association_location", "location_id", "coded_line_id"),
 )
 
 class Location(Base):
     __tablename__ = "location"
     __table_args__ = (
         CheckConstraint("start_line <= end_line"),
+        Index("ix_location_document_index_lines", "document_index_id", "start_line", 
+                "end_line"),
     )
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     start_line: Mapped[int]
@@ -82,6 +90,11 @@ class Coder(Base):
 
 class CodedLine(Base):
     __tablename__ = "coded_line"
+    __table_args__ = (
+        Index("ix_coded_line_coder_code_line", "coder_id", "code_id", "line"),
+        Index("ix_coded_line_code_coder_line", "code_id", "coder_id", "line"),
+        Index("ix_coded_line_line", "line"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     line: Mapped[int]
     coder_id: Mapped[str] = mapped_column(ForeignKey(Coder.name))
@@ -92,3 +105,8 @@ class CodedLine(Base):
         secondary=coded_line_location_association_table,
         back_populates="coded_lines"
     )
+
+class EntityCache(Base):
+    __tablename__ = "entity_cache"
+    file_hash: Mapped[str] = mapped_column(primary_key=True)
+    entities: Mapped[str]
@@ -1,6 +1,9 @@
 import re
+import codecs
+import numpy as np
 from more_itertools import peekable
 from difflib import unified_diff
+from concurrent.futures import ProcessPoolExecutor
 from subprocess import run
 
 def get_git_diff(path):
@@ -16,32 +19,113 @@ def get_diff(path0, path1):
         doc1 = [line for line in fh]
     return ''.join(unified_diff(doc0, doc1))
 
+def get_diffs(path_pairs, jobs=1):
+    """Gets diffs between each (path0, path1) in path_pairs, returning a list of diffs
+    in the same order. When jobs is greater than 1, diffs are computed in a pool of 
+    worker processes.
+    """
+    path_pairs = list(path_pairs)
+    if jobs > 1 and len(path_pairs) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(get_diff, *zip(*path_pairs), chunksize=8))
+    return [get_diff(path0, path1) for path0, path1 in path_pairs]
+
+def get_git_range_diffs(revisions, path):
+    """Runs a single `git diff` over everything in path (a directory), returning a list
+    of (old_path, new_path, diff) for each changed file, with paths relative to path.
+    revisions is passed to git as-is, so it may be a range ("HEAD~1..HEAD") or a 
+    single revision, which is compared with the working tree. 
+    """
+    result = run(
+        ["git", "-c", "core.quotePath=false", "diff", "--no-color", "--no-ext-diff", 
+            "--no-renames", "--relative", revisions, "--", "."],
+        cwd=path, capture_output=True, text=True,
+    )
+    if result.returncode:
+        raise ValueError(result.stderr.strip())
+    return list(split_diff(result.stdout))
+
+def split_diff(diff):
+    """Splits a diff covering several files into (old_path, new_path, diff) for each 
+    file. old_path is None for added files, and new_path is None for deleted files.
+    Files without a textual diff (e.g. binary files) are skipped.
+    """
+    for file_diff in re.split(r'^(?=diff --git )', diff, flags=re.MULTILINE):
+        lines = file_diff.split('\n')
+        for i, line in enumerate(lines[:-1]):
+            if line.startswith('--- ') and lines[i + 1].startswith('+++ '):
+                old_path = read_diff_path(line[4:], 'a/')
+                new_path = read_diff_path(lines[i + 1][4:], 'b/')
+                yield (old_path, new_path, file_diff)
+                break
+
+def read_diff_path(path, prefix):
+    """Reads a path from a "---" or "+++" line of a git diff. Returns None for 
+    /dev/null. git ends paths containing spaces with a tab, and quotes paths 
+    containing special characters, escaping bytes in octal.
+    """
+    path = path.rstrip('\t')
+    if path.startswith('"') and path.endswith('"'):
+        path = codecs.escape_decode(path[1:-1].encode())[0].decode()
+    if path == '/dev/null':
+        return None
+    return path.removeprefix(prefix)
+
 def reindex_coded_lines(coded_lines, diff):
     """Returns a new version of coded_lines, with line numbers updated to account for diff.
-    Assumes coded_lines are sorted by line number.
+    Coded lines on lines which were deleted are dropped.
+    """
+    coded_lines = list(coded_lines)
+    map_lines = get_line_mapping(read_diff_offsets(diff))
+    new_lines = map_lines([line for code, coder, line, path in coded_lines]).tolist()
+    return [
+        (code, coder, new_line, path) 
+        for (code, coder, line, path), new_line in zip(coded_lines, new_lines)
+        if new_line >= 0
+    ]
+
+def get_line_mapping(offsets):
+    """Returns a function which maps an array of line numbers in the old version of 
+    a document to an array of line numbers in the new version, with -1 for lines 
+    which were deleted. offsets is a list of (line, offset) tuples as returned by 
+    read_diff_offsets, whose line numbers start at 1; line numbers passed to the 
+    function start at 0.
+    Each offset shifts all following lines, so a line's new number is its old number
+    plus the sum of the offsets preceding it, found with a binary search over the 
+    cumulative offsets.
     """
-    offsets = peekable(read_diff_offsets(diff))
-    current_offset_line = 0
-    current_offset = 0
-    cum_offset = 0
-    reindexed_coded_lines = []
-    for code, coder, line, path in coded_lines:
-        try:
-            if offsets.peek()[0] <= line:
-                current_offset_line, current_offset = next(offsets)
-                cum_offset += current_offset
-        except StopIteration:
-            pass
-
-
-    return reindexed_coded_lines
+    breaks, shifts, deleted = [], [], []
+    for line, offset in offsets:
+        if offset > 0:
+            breaks.append(line - 1)
+        else:
+            deleted.append((line - 1, line - 1 - offset))
+            breaks.append(line - 1 - offset)
+        shifts.append(offset)
+    order = np.argsort(breaks, kind="stable")
+    breaks = np.array(breaks, dtype=np.int64)[order]
+    cumulative_shifts = np.concatenate([[0], np.cumsum(np.array(shifts, dtype=np.int64)[order])])
+    deleted_starts = np.array(sorted(start for start, end in deleted), dtype=np.int64)
+    deleted_ends = np.array(sorted(end for start, end in deleted), dtype=np.int64)
+
+    def map_lines(lines):
+        lines = np.asarray(lines, dtype=np.int64)
+        new_lines = lines + cumulative_shifts[np.searchsorted(breaks, lines, side='right')]
+        if len(deleted_starts):
+            i = np.searchsorted(deleted_starts, lines, side='right') - 1
+            is_deleted = (i >= 0) & (lines < deleted_ends[np.maximum(i, 0)])
+            new_lines[is_deleted] = -1
+        return new_lines
+    return map_lines
 
 def read_diff_offsets(diff):
     """Reads a unified diff and returns a list of (line, offset) tuples.
     For example, (6, 2) represents an insertion of 2 lines at line 6. 
     Adjacent deletions and insertions are assumed to be edited versions
     of the same line, so if 4 lines were deleted and 3 lines inserted at
-    line 10, this would be represented as (13, -1).
+    line 10, this would be represented as (13, -1), and if 3 lines were deleted
+    and 4 lines inserted at line 10, this would be represented as (13, 1).
+    Line numbers refer to the old version of the document.
     """
     offsets = []
     lines = peekable(diff.split('\n'))
@@ -70,6 +154,9 @@ def read_hunk(lines):
     try:
         while not lines.peek().startswith('@'):
             line = next(lines)
+            if line.startswith('\\'):
+                # "\ No newline at end of file"
+                continue
             if in_op:
                 if line[0] == '-':
                     minus += 1
@@ -78,9 +165,9 @@ def read_hunk(lines):
                 else:
                     in_op = False
                     if plus - minus > 0:
-                        ops.append((op_start_line_number, plus - minus))
+                        ops.append((op_start_line_number + minus, plus - minus))
                     elif plus - minus < 0:
-                        ops.append((op_start_line_number + minus - plus - 1, plus - minus))
+                        ops.append((op_start_line_number + plus, plus - minus))
             else:
                 if line[0] == '-':
                     in_op = True
@@ -90,18 +177,24 @@ def read_hunk(lines):
                     in_op = True
                     op_start_line_number = line_number
                     minus, plus = 0, 1
-            line_number += 1
+            if line[0] != '+':
+                line_number += 1
     finally:
         if in_op:
             if plus - minus > 0:
-                ops.append((op_start_line_number, plus - minus))
+                ops.append((op_start_line_number + minus, plus - minus))
             elif plus - minus < 0:
-                ops.append((op_start_line_number + minus - plus - 1, plus - minus))
+                ops.append((op_start_line_number + plus, plus - minus))
         return ops
 
 def read_line_number(hunk_preamble):
-    match = re.match('\s*@@ \-(\d+)', hunk_preamble)
-    return int(match.group(1))
+    """Returns the line number in the old version of the document at which a hunk
+    starts. A hunk which covers no lines of the old version (e.g. "@@ -8,0 +9,3 @@")
+    gives the line after which lines are inserted.
+    """
+    match = re.match(r'\s*@@ \-(\d+)(?:,(\d+))?', hunk_preamble)
+    line_number = int(match.group(1))
+    return line_number + 1 if match.group(2) == "0" else line_number
 
 def in_git_repo():
     "Checks whether the current working directory is in a git repo."
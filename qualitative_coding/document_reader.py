@@ -0,0 +1,93 @@
+# Random access to lines of corpus documents.
+
+import mmap
+import numpy as np
+from pathlib import Path
+
+class DocumentReader:
+    """
+    Reads selected lines from a corpus document without reading the whole file.
+    The document is memory-mapped, and lines are located using line offsets:
+    an array holding the byte offset at which each line ends. Line offsets may
+    be supplied (e.g. from QCCorpus.get_line_offsets); otherwise they are computed.
+    Lines are split on "\n" and returned as strings including their line endings, 
+    with "\r\n" translated to "\n", as when iterating over a file opened in text mode.
+
+        with DocumentReader(path) as reader:
+            lines = reader.get_lines(10, 20)
+    """
+    encoding = "utf-8"
+    chunk_size = 1 << 24
+
+    @classmethod
+    def compute_line_offsets(cls, data):
+        """Returns an int64 array of the byte offset at which each line of data
+        (bytes, or a buffer such as an mmap) ends. Scans data in chunks, so memory
+        use is proportional to the number of lines, not to the size of data.
+        """
+        view = np.frombuffer(data, dtype=np.uint8) if len(data) else np.zeros(0, np.uint8)
+        ends = []
+        for start in range(0, len(view), cls.chunk_size):
+            chunk = view[start:start + cls.chunk_size]
+            ends.append(np.flatnonzero(chunk == ord("\n")) + start + 1)
+        if len(view) and view[-1] != ord("\n"):
+            ends.append(np.array([len(view)]))
+        return np.concatenate(ends).astype(np.int64) if ends else np.zeros(0, np.int64)
+
+    @classmethod
+    def compute_character_offsets(cls, data, line_offsets):
+        """Returns an int64 array of the character offset at which each line ends,
+        given the byte offsets at which lines end. Characters are counted as 
+        text-mode reading counts them: UTF-8 continuation bytes are not counted, 
+        and "\r\n" counts as a single character.
+        """
+        view = np.frombuffer(data, dtype=np.uint8) if len(data) else np.zeros(0, np.uint8)
+        skipped = [np.zeros(0, np.int64)]
+        for start in range(0, len(view), cls.chunk_size):
+            chunk = view[start:start + cls.chunk_size + 1]
+            mask = (chunk[:cls.chunk_size] & 0xC0) == 0x80
+            mask[:len(chunk) - 1] |= (chunk[:-1] == ord("\r")) & (chunk[1:] == ord("\n"))
+            skipped.append(np.flatnonzero(mask) + start)
+        skipped = np.concatenate(skipped)
+        return np.asarray(line_offsets, dtype=np.int64) - np.searchsorted(skipped, line_offsets)
+
+    def __init__(self, path, line_offsets=None):
+        self.path = Path(path)
+        self.file = open(self.path, 'rb')
+        if self.path.stat().st_size:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = b""
+        if line_offsets is None:
+            line_offsets = self.compute_line_offsets(self.data)
+        self.line_offsets = line_offsets
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def character_offsets(self):
+        "Returns the character offset at which each line ends"
+        return self.compute_character_offsets(self.data, self.line_offsets)
+
+    def __len__(self):
+        return len(self.line_offsets)
+
+    def get_lines(self, start, stop):
+        "Returns lines start (inclusive) through stop (exclusive) as a list of strings."
+        start, stop = max(0, start), min(len(self), stop)
+        if start >= stop:
+            return []
+        ends = self.line_offsets[start:stop].tolist()
+        begins = [int(self.line_offsets[start - 1]) if start > 0 else 0] + ends[:-1]
+        return [
+            self.data[begin:end].decode(self.encoding).replace("\r\n", "\n")
+            for begin, end in zip(begins, ends)
+        ]
@@ -24,8 +24,10 @@ def read_file_list(filename):
         return Path(filename).read_text().split("\n")
 
 def iter_paragraph_lines(fh):
+    "Yields (start, end) line ranges of paragraphs. An empty file has no paragraphs."
     p_start = 0
     in_whitespace = False
+    i = -1
     for i, line in enumerate(fh):
         if line.strip() == "":
             in_whitespace = True
@@ -33,7 +35,8 @@ def iter_paragraph_lines(fh):
             yield p_start, i
             p_start = i
             in_whitespace = False
-    yield p_start, i + 1
+    if i >= 0:
+        yield p_start, i + 1
 
 def merge_ranges(ranges, clamp=None):
     "Overlapping ranges? Let's fix that. Optionally supply clamp=[0, 100]"
@@ -7,12 +7,14 @@ from qualitative_coding.exceptions import QCError
 from qualitative_coding.migrations.migration_0_2_3 import Migrate_0_2_3
 from qualitative_coding.migrations.migration_1_0_0 import Migrate_1_0_0
 from qualitative_coding.migrations.migration_1_4_0 import Migrate_1_4_0
+from qualitative_coding.migrations.migration_1_8_0 import Migrate_1_8_0
 from qualitative_coding.helpers import read_settings
 
 migrations = [
     Migrate_0_2_3(),
     Migrate_1_0_0(),
     Migrate_1_4_0(),
+    Migrate_1_8_0(),
 ]
 
 def migrate(settings_path, target=None):
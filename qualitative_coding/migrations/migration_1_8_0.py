@@ -0,0 +1,61 @@
+from sqlalchemy import (
+    create_engine,
+    text,
+)
+from qualitative_coding.migrations.migration import QCMigration
+from qualitative_coding.helpers import read_settings
+from qualitative_coding.database.models import Base, EntityCache
+from pathlib import Path
+
+class Migrate_1_8_0(QCMigration):
+    """Adds covering indexes for the most common query shapes (filtering coded 
+    lines by coder, code, and line; resolving lines to paragraph Locations; and 
+    joining Locations back to coded lines), and then runs ANALYZE so that 
+    SQLite's query planner uses them.
+    Also adds columns to document recording the file stat at which each 
+    document's hash was last verified, and the document's line offsets, and 
+    a table caching the named entities found in each document's text.
+    """
+    _version = "1.8.0"
+    document_columns = {
+        "file_size": "INTEGER", 
+        "file_mtime_ns": "INTEGER", 
+        "file_inode": "INTEGER",
+        "line_offsets": "BLOB",
+    }
+
+    def apply(self, settings_path):
+        engine = self.get_engine(settings_path)
+        with engine.begin() as conn:
+            existing_columns = self.get_document_columns(conn)
+            for column, column_type in self.document_columns.items():
+                if column not in existing_columns:
+                    conn.execute(text(f"ALTER TABLE document ADD COLUMN {column} {column_type}"))
+            EntityCache.__table__.create(conn, checkfirst=True)
+            for index in self.get_indexes():
+                index.create(conn, checkfirst=True)
+            conn.execute(text("ANALYZE"))
+        self.set_setting(settings_path, "qc_version", "1.8.0")
+
+    def revert(self, settings_path):
+        engine = self.get_engine(settings_path)
+        with engine.begin() as conn:
+            for index in self.get_indexes():
+                index.drop(conn, checkfirst=True)
+            EntityCache.__table__.drop(conn, checkfirst=True)
+            existing_columns = self.get_document_columns(conn)
+            for column in self.document_columns:
+                if column in existing_columns:
+                    conn.execute(text(f"ALTER TABLE document DROP COLUMN {column}"))
+        self.set_setting(settings_path, "qc_version", "1.4.0")
+
+    def get_engine(self, settings_path):
+        settings = read_settings(settings_path)
+        db_file = Path(settings_path).parent / settings['database']
+        return create_engine(f"sqlite:///{db_file}")
+
+    def get_indexes(self):
+        return [index for table in Base.metadata.sorted_tables for index in table.indexes]
+
+    def get_document_columns(self, conn):
+        return set(row[1] for row in conn.execute(text("PRAGMA table_info(document)")))
@@ -1,12 +1,14 @@
 from qualitative_coding.exceptions import QCError
 from qualitative_coding.corpus import QCCorpus
 from qualitative_coding.tree_node import TreeNode
+from qualitative_coding.document_reader import DocumentReader
 from xmlschema.validators.exceptions import XMLSchemaValidationError
 from collections import defaultdict
 from subprocess import run
 from xmlschema import validate
 from pathlib import Path
 import re
+import numpy as np
 import xml.etree.ElementTree as ET
 import importlib.resources
 import shutil
@@ -20,60 +22,74 @@ class REFIQDAReader:
     NOTE: Currently does not support importing memos.
     """
     default_coder = "default"
+    unsupported_tags = ["Variables", "Cases", "Notes", "Links", "Graphs", "Description", 
+            "NoteRef"]
 
     def __init__(self, qdpxfile):
         self.qdpxfile = qdpxfile
         self.validate(qdpxfile)
 
     def unpack_project(self, destination):
+        """Imports the project into destination, which must be an empty directory.
+        project.qde is parsed as a stream, and each source is copied directly 
+        from the archive into the corpus, so neither the archive nor the 
+        project XML is ever unpacked in full.
+        """
         self.dest_path = Path(destination)
         if not self.dest_path.exists():
-            raise QCError(f"Cannot import project to {dest_path}; no such directory.")
+            raise QCError(f"Cannot import project to {self.dest_path}; no such directory.")
         if len(list(self.dest_path.iterdir())) > 0:
             raise QCError("You can only import a project into an empty directory.")
         QCCorpus.initialize()
         self.corpus = QCCorpus(self.dest_path / "settings.yaml")
-        (self.dest_path / "source").mkdir()
-        (self.dest_path / "source" / "import").mkdir()
-        with zipfile.ZipFile(self.qdpxfile, 'r', zipfile.ZIP_DEFLATED) as zf:
-            zf.extractall((self.dest_path / "source"))
-        tree = ET.parse(self.dest_path / "source" / "project.qde")
-        with self.corpus.session():
-            self.unpack_xml(tree.getroot())
-
-    def unpack_xml(self, root):
+        with zipfile.ZipFile(self.qdpxfile, 'r') as zf:
+            with zf.open("project.qde") as qde:
+                with self.corpus.session():
+                    self.unpack_xml(qde, zf)
+
+    def unpack_xml(self, qde, zf):
+        """Parses project XML from a stream, unpacking each top-level element 
+        once it has been read, and then discarding it. Each source is unpacked 
+        and discarded in the same way, so memory use does not grow with the 
+        number of sources. The REFI-QDA schema requires Users and CodeBook to 
+        precede Sources. 
+        Documents and their coded lines are committed in batches.
+        """
         self.coder_guids = {}
-        for child in root:
-            if child.tag.endswith("Users"):
-                self.unpack_coders(child)
-        for child in root:
-            if child.tag.endswith("CodeBook"):
-                self.unpack_codebook(child)
-        for child in root:
-            if child.tag.endswith("Variables"):
-                log.warning("{self.qdpxfile} contains Variables, which are not supported by qc.")
-        self.unpack_unsupported(root, "Variables")
-        self.unpack_unsupported(root, "Cases")
-        for child in root:
-            if child.tag.endswith("Sources"):
-                self.unpack_sources(child)
-        self.unpack_unsupported(root, "Notes")
-        self.unpack_unsupported(root, "Links")
-        self.unpack_unsupported(root, "Graphs")
-        self.unpack_unsupported(root, "Description")
-        self.unpack_unsupported(root, "NoteRef")
-
-    def unpack_unsupported(self, root, tagname):
-        for child in root:
-            if child.tag.endswith(tagname):
+        self.code_guids = {}
+        self.document_guids = {}
+        self.pending_sources = 0
+        ancestors = []
+        for event, elem in ET.iterparse(qde, events=("start", "end")):
+            if event == "start":
+                ancestors.append(elem)
+                continue
+            ancestors.pop()
+            if len(ancestors) == 1:
+                if elem.tag.endswith("Users"):
+                    self.unpack_coders(elem)
+                elif elem.tag.endswith("CodeBook"):
+                    self.unpack_codebook(elem)
+                else:
+                    self.unpack_unsupported(elem)
+                ancestors[0].remove(elem)
+            elif len(ancestors) == 2 and ancestors[1].tag.endswith("Sources"):
+                self.unpack_source(elem, zf)
+                ancestors[1].remove(elem)
+        self.corpus.get_session().commit()
+
+    def unpack_unsupported(self, elem):
+        for tagname in self.unsupported_tags:
+            if elem.tag.endswith(tagname):
                 log.warning(f"{self.qdpxfile} contains {tagname}, which are not supported by qc.")
 
     def unpack_coders(self, users):
         for user in users:
             name = user.attrib['name']
             guid = user.attrib['guid']
-            self.corpus.get_or_create_coder(name)
             self.coder_guids[guid] = name
+        self.corpus.create_coders(set(self.coder_guids.values()))
+        self.corpus.get_session().commit()
 
     def create_default_coder_if_none_defined(self):
         if not hasattr(self, "coder_guids"):
@@ -90,7 +106,6 @@ class REFIQDAReader:
         def unpack_code(code, parent):
             name = code.attrib['name']
             guid = code.attrib['guid']
-            self.corpus.get_or_create_code(name)
             self.code_guids[guid] = name
             node = TreeNode(name, parent=parent)
             parent.children.append(node)
@@ -101,52 +116,93 @@ class REFIQDAReader:
         for code in codes:
             unpack_code(code, self.code_tree)
 
+        self.corpus.create_codes(set(self.code_guids.values()))
+        self.corpus.get_session().commit()
         TreeNode.write_yaml(self.corpus.codebook_path, self.code_tree)
 
-    def unpack_sources(self, sources):
-        self.document_guids = {}
-        for source in sources:
-            if not source.attrib.get('plainTextPath'):
-                log.warning(
-                    f"Skipping import of source {source['name']}; " + 
-                    "only text sources are supported."
-                )
-                continue
-            guid = source.attrib['guid']
-            plain_text_path = source.attrib['plainTextPath'].replace("internal://", "")
-            qdpx_path = self.dest_path / "source" / "sources" / plain_text_path
-            importable_path = (self.dest_path / "source" / "import" / source.attrib['name']).with_suffix(
-                qdpx_path.suffix
+    def unpack_source(self, source, zf):
+        """Copies a source's text from the archive into the corpus, and imports 
+        its coded lines. Does not commit the session, except once per batch of
+        sources.
+        """
+        if not source.attrib.get('plainTextPath'):
+            log.warning(
+                f"Skipping import of source {source.attrib.get('name')}; " + 
+                "only text sources are supported."
             )
-            log.info(f"Copying {qdpx_path} -> {importable_path}")
-            shutil.copyfile(qdpx_path, importable_path)
-            self.document_guids[guid] = importable_path.name
-            self.corpus.import_media(importable_path, importer="verbatim")
-            line_positions = self.line_positions(importable_path)
-            coded_lines = defaultdict(list)
-            for selection in source:
-                if selection.tag.endswith("PlainTextSelection"):
-                    match = re.match("line:(\d+)", selection.attrib.get("name", ""))
-                    if match:
-                        line = int(match.group(1))
-                    else:
-                        position = int(selection.attrib['startPosition'])
-                        line = self.get_line_for_position(position, line_positions)
-                    for coding in selection:
-                        if coding.tag.endswith("Coding"):
-                            coder_guid = coding.attrib['creatingUser']
-                            coder = self.coder_guids.get(coder_guid, self.default_coder)
-                            for coderef in coding:
-                                if coderef.tag.endswith("CodeRef"):
-                                    code = self.code_guids[coderef.attrib['targetGUID']]
-                                    coded_lines[coder].append({'line': line, 'code_id': code})
-            for coder, cls in coded_lines.items():
-                self.corpus.update_coded_lines(importable_path.name, coder, cls)
-
-    def get_line_for_position(self, position, line_positions):
-        for line, (start, end) in enumerate(line_positions):
-            if position >= start:
-                return line
+            return
+        guid = source.attrib['guid']
+        plain_text_path = source.attrib['plainTextPath'].replace("internal://", "")
+        corpus_path = self.corpus_path_for_source(source.attrib['name'], 
+                Path(plain_text_path).suffix)
+        self.copy_source(zf, "sources/" + plain_text_path, corpus_path)
+        self.corpus.register_document(self.corpus.corpus_dir / corpus_path, commit=False)
+        self.document_guids[guid] = str(corpus_path)
+        selections = []
+        for selection in source:
+            if selection.tag.endswith("PlainTextSelection"):
+                match = re.match(r"line:(\d+)", selection.attrib.get("name", ""))
+                line = int(match.group(1)) if match else None
+                position = int(selection.attrib['startPosition'])
+                codings = []
+                for coding in selection:
+                    if coding.tag.endswith("Coding"):
+                        coder_guid = coding.attrib['creatingUser']
+                        coder = self.coder_guids.get(coder_guid, self.default_coder)
+                        for coderef in coding:
+                            if coderef.tag.endswith("CodeRef"):
+                                code = self.code_guids[coderef.attrib['targetGUID']]
+                                codings.append((coder, code))
+                selections.append((line, position, codings))
+        positions = [position for line, position, codings in selections if line is None]
+        if positions:
+            position_lines = iter(self.get_lines_for_positions(corpus_path, positions).tolist())
+        coded_lines = defaultdict(list)
+        for line, position, codings in selections:
+            if line is None:
+                line = next(position_lines)
+            for coder, code in codings:
+                coded_lines[coder].append({'line': line, 'code_id': code})
+        for coder, cls in coded_lines.items():
+            self.corpus.update_coded_lines(str(corpus_path), coder, cls, commit=False)
+        self.pending_sources += 1
+        if self.pending_sources >= self.corpus.batch_size:
+            self.corpus.get_session().commit()
+            self.pending_sources = 0
+
+    def corpus_path_for_source(self, name, suffix):
+        """Returns the path within the corpus for a source with the given name.
+        Names which are not relative paths within the corpus are reduced to 
+        their final component.
+        """
+        path = Path(name)
+        if path.is_absolute() or ".." in path.parts:
+            path = Path(path.name)
+        return path.with_suffix(suffix)
+
+    def copy_source(self, zf, member, corpus_path):
+        "Copies a source from the archive into the corpus"
+        dest = self.corpus.corpus_dir / corpus_path
+        if dest.exists():
+            raise QCError(f"Cannot import {member} to {dest}; the file already exists.")
+        try:
+            info = zf.getinfo(member)
+        except KeyError:
+            raise QCError(f"{self.qdpxfile} does not contain {member}")
+        log.info(f"Copying {member} -> {dest}")
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        with zf.open(info) as src, open(dest, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+
+    def get_lines_for_positions(self, corpus_path, positions):
+        """Returns an array of the line containing each character position in a 
+        corpus document. Positions past the end of the document are mapped to 
+        its last line.
+        """
+        with DocumentReader(self.corpus.corpus_dir / corpus_path) as reader:
+            line_ends = reader.character_offsets()
+        lines = np.searchsorted(line_ends, positions, side='right')
+        return np.minimum(lines, max(len(line_ends) - 1, 0))
 
     def validate(self, qdpxfile):
         if not Path(qdpxfile).suffix == ".qdpx":
@@ -157,11 +213,12 @@ class REFIQDAReader:
             zroot = zipfile.Path(zf)
             qde = zroot / "project.qde"
             if not qde.exists():
-                raise QCError("{qdpxfile} does not contain project.qde")
+                raise QCError(f"{qdpxfile} does not contain project.qde")
             qcf = importlib.resources.files("qualitative_coding")
             schema_path = qcf / "refi_qda" / "schema.xsd"
             try:
-                validate(qde.read_text(), schema_path)
+                with qde.open('rb') as fh:
+                    validate(fh, schema_path, lazy=True)
             except XMLSchemaValidationError as err:
                 raise QCError(
                     f"When reading {qdpxfile}, project.qde did not validate " + 
@@ -169,19 +226,6 @@ class REFIQDAReader:
                     repr(err)
                 )
 
-    def line_positions(self, corpus_file_path):
-        """returns a list of (start, end) character positions for lines in doc.
-        """
-        text = (self.corpus.corpus_dir / corpus_file_path).read_text()
-        lines = []
-        index = 0
-        for line in text:
-            start = index
-            end = index + len(line)
-            lines.append((start, end))
-            index += len(line)
-        return lines
-
     def print_tree(self, project_path):
         result = run("tree", cwd=project_path, capture_output=True, text=True, shell=True)
         print(result.stdout)
@@ -1,12 +1,15 @@
 from qualitative_coding.corpus import QCCorpus
 from qualitative_coding.exceptions import QCError, InvalidParameter
-from tempfile import TemporaryDirectory
-from shutil import copyfile
 from pathlib import Path
-from subprocess import run
-from collections import defaultdict
-from hashlib import md5
+from io import TextIOWrapper
+from contextlib import ExitStack
+from copy import copy
 import os
+from itertools import groupby
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from operator import itemgetter
+from hashlib import md5
 from importlib.metadata import metadata
 from zipfile import ZipFile, ZIP_DEFLATED
 from uuid import UUID
@@ -14,69 +17,139 @@ from xml.etree.ElementTree import (
     Element,
     Comment,
     tostring,
+    fromstring,
 )
+from xml.sax.saxutils import XMLGenerator
 import structlog
 
 log = structlog.get_logger()
 
+
 class REFIQDAWriter:
     """Exports a QC project as a REFI-QDA project.
     See specification at https://www.qdasoftware.org/
     """
-    def __init__(self, settings, debug=False):
+    def __init__(self, settings, debug=False, jobs=1):
+        if jobs < 1:
+            raise InvalidParameter(f"jobs ({jobs}) must be at least 1.")
         self.settings = settings
         self.corpus = QCCorpus(settings)
         self.debug = debug
+        self.jobs = jobs
 
-    def write(self, outpath):
-        """Write a zip file at the given outpath
+    def write(self, outpath, incremental=False):
+        """Write a zip file at the given outpath.
+        project.qde is streamed into the archive as it is generated, and source 
+        files are compressed directly from the corpus directory, so no staging 
+        copy of the project is made. The archive is written to a temporary file
+        which then replaces outpath.
+        When incremental is True and an archive already exists at outpath, 
+        sources which have not changed since it was written are copied from it
+        rather than read from the corpus. 
         """
-        if Path(outpath).suffix != ".qdpx":
+        outpath = Path(outpath)
+        if outpath.suffix != ".qdpx":
             raise InvalidParameter("REFI-QDA projects must have suffix .qdpx")
-        with TemporaryDirectory() as tempdir:
-            project_path = Path(tempdir)
-            qde = self.write_xml(project_path / "project.qde")
-            self.write_corpus(qde, project_path / "sources")
-            if self.debug:
-                self.print_tree(project_path)
-            with ZipFile(outpath, 'w', ZIP_DEFLATED) as zf:
-                for dirpath, dirnames, filenames in os.walk(tempdir):
-                    for fn in filenames:
-                        path = Path(dirpath) / fn
-                        zf.write(path, arcname=path.relative_to(tempdir))
+        previous = outpath if incremental and outpath.exists() else None
+        temp_path = outpath.with_name(f".{outpath.name}.{os.getpid()}.tmp")
+        try:
+            with ZipFile(temp_path, 'w', ZIP_DEFLATED) as zf:
+                with zf.open("project.qde", 'w') as qde:
+                    with TextIOWrapper(qde, encoding="utf-8") as fh:
+                        self.stream_xml(fh)
+                self.write_corpus(zf, previous=previous)
+                if self.debug:
+                    print('\n'.join(zf.namelist()))
+            os.replace(temp_path, outpath)
+        finally:
+            temp_path.unlink(missing_ok=True)
 
     def write_xml(self, outpath):
-        root = self.xml_root()
-        root.append(self.users_to_xml())
-        root.append(self.codebook_to_xml())
-        root.append(self.sources_to_xml())
+        "Write project XML to the given outpath"
+        with open(outpath, 'w', encoding="utf-8") as fh:
+            self.stream_xml(fh)
+
+    def stream_xml(self, fh):
+        """Writes project XML to a text stream. Users and the codebook are small;
+        sources are generated and written one at a time, so the XML for the 
+        whole project is never held in memory.
+        """
+        xml = XMLGenerator(fh, encoding="utf-8", short_empty_elements=False)
+        xml.startDocument()
+        xml.startElement("Project", self.project_attributes())
+        self.write_element(fh, self.users_to_xml())
+        self.write_element(fh, self.codebook_to_xml())
+        xml.startElement("Sources", {})
+        for source in self.iter_sources_text():
+            if self.debug:
+                print(source)
+            fh.write(source)
+        xml.endElement("Sources")
+        xml.endElement("Project")
+        xml.endDocument()
+
+    def write_element(self, fh, element):
+        text = tostring(element, encoding="unicode")
         if self.debug:
-            print(tostring(root, encoding="unicode"))
-        outpath.write_text(tostring(root, encoding="unicode"))
-        return root
-
-    def write_corpus(self, qde, outpath):
-        outpath.mkdir()
-        for child in qde:
-            if child.tag.endswith("Sources"):
-                for source in child:
-                    project_path = self.corpus.corpus_dir / source.attrib['name']
-                    export_path = outpath / source.attrib['plainTextPath'].replace("internal://", "")
+            print(text)
+        fh.write(text)
+
+    def write_corpus(self, zf, previous=None):
+        """Adds each corpus document to the zip file, streaming it from the corpus dir.
+        Each source's entry comment records the hash of the document it holds. 
+        When previous is the path of an earlier archive, sources whose hash 
+        matches the hash recorded there are copied from it.
+        """
+        with self.corpus.session():
+            file_hashes = self.current_file_hashes()
+        with ExitStack() as stack:
+            previous_zf = stack.enter_context(ZipFile(previous)) if previous else None
+            for file_path, file_hash in file_hashes:
+                project_path = self.corpus.corpus_dir / file_path
+                export_path = "sources/" + self.internal_path(file_path)
+                info = previous_zf and self.previous_entry(previous_zf, export_path)
+                if info and info.comment == file_hash.encode():
+                    log.info(f"Reusing unchanged {export_path}")
+                    zf.writestr(copy(info), previous_zf.read(info))
+                else:
                     log.info(f"Copying {project_path} -> {export_path}")
-                    copyfile(project_path, export_path)
+                    zf.write(project_path, arcname=export_path)
+                    zf.getinfo(export_path).comment = file_hash.encode()
 
-    def print_tree(self, project_path):
-        result = run("tree", cwd=project_path, capture_output=True, text=True, shell=True)
-        print(result.stdout)
+    def previous_entry(self, previous_zf, export_path):
+        "Returns the ZipInfo for export_path in a previous archive, or None"
+        try:
+            return previous_zf.getinfo(export_path)
+        except KeyError:
+            return None
 
-    def xml_root(self):
-        root = Element("Project")
-        root.set("xmlns", "urn:QDA-XML:project:1.0")
-        root.set("xmlns:xsi", "http://www.w3.org/2001/XMLSchema-instance")
+    def current_file_hashes(self):
+        """Returns a list of (file_path, file_hash) for each document. 
+        Stored hashes are used for files whose stat matches the stat recorded 
+        when their hash was last verified; other files are hashed.
+        """
+        file_hashes, to_hash = [], []
+        for doc in self.corpus.iter_documents():
+            path = self.corpus.corpus_dir / doc.file_path
+            if self.corpus.file_stat_matches(doc, path.stat()):
+                file_hashes.append((doc.file_path, doc.file_hash))
+            else:
+                to_hash.append(doc.file_path)
+        hashes = self.corpus.hash_files([self.corpus.corpus_dir / fp for fp in to_hash])
+        return sorted(file_hashes + list(zip(to_hash, hashes)))
+
+    def project_attributes(self):
         version = metadata('qualitative-coding')['version']
-        root.set("origin", f"qc {version}")
-        root.set("name", "qc project")
-        return root
+        return {
+            "xmlns": "urn:QDA-XML:project:1.0",
+            "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
+            "origin": f"qc {version}",
+            "name": "qc project",
+        }
+
+    def internal_path(self, file_path):
+        "Returns the path of a source within the archive's sources directory"
+        return internal_path(file_path)
 
     def codebook_to_xml(self):
         """Render the codebook as XML.
@@ -120,64 +193,125 @@ class REFIQDAWriter:
 
     def sources_to_xml(self):
         sources = Element("Sources")
-        with self.corpus.session():
-            sources = Element("Sources")
-            for doc in self.corpus.get_documents():
-                source = Element("TextSource")
-                source_guid = self.guid(doc.file_path)
-                suffix = Path(doc.file_path).suffix
-                internal_path = str(Path(source_guid).with_suffix(suffix))
-                source.set("plainTextPath", "internal://" + internal_path)
-                source.set("guid", source_guid)
-                source.set("name", doc.file_path)
-                doc_line_positions = self.line_positions(doc.file_path)
-                coded_lines = self.corpus.get_coded_lines(file_list=[doc.file_path])
-                lines_with_codes = defaultdict(list)
-                for cl in coded_lines:
-                    lines_with_codes[cl.line].append(cl)
-                for line, cls in lines_with_codes.items():
-                    selection = Element("PlainTextSelection")
-                    selection.set("guid", self.selection_guid(doc.file_path, line))
-                    selection.set("name", f"line:{line}")
-                    selection.set("startPosition", str(doc_line_positions[line][0]))
-                    selection.set("endPosition", str(doc_line_positions[line][1]))
-                    for code, coder, line, file_path in cls:
-                        coding = Element("Coding")
-                        coding.set("guid", self.coding_guid(code, coder, line, file_path))
-                        coding.set("creatingUser", self.coder_guid(coder))
-                        code_ref = Element("CodeRef")
-                        code_ref.set("targetGUID", self.code_guids[code])
-                        coding.append(code_ref)
-                        selection.append(coding)
-                    source.append(selection)
-                sources.append(source)
+        for source in self.iter_sources_xml():
+            sources.append(source)
         return sources
 
-    def line_positions(self, corpus_file_path):
-        """returns a list of (start, end) character positions for lines in doc.
+    def iter_sources_xml(self):
+        "Yields a TextSource element for each document"
+        for text in self.iter_sources_text():
+            yield fromstring(text)
+
+    def iter_sources_text(self):
+        """Yields serialized TextSource elements for each document, in order of 
+        file path. When jobs is greater than 1, sources are serialized in a pool 
+        of worker processes; a bounded number of sources are in flight at once, 
+        so memory use does not grow with the size of the corpus.
+        """
+        sources = self.iter_source_data()
+        if self.jobs > 1:
+            with ProcessPoolExecutor(max_workers=self.jobs, initializer=set_code_guids, 
+                    initargs=(self.code_guids,)) as pool:
+                futures = deque()
+                for source in sources:
+                    futures.append(pool.submit(serialize_source, *source))
+                    if len(futures) >= self.jobs * 4:
+                        yield futures.popleft().result()
+                while futures:
+                    yield futures.popleft().result()
+        else:
+            set_code_guids(self.code_guids)
+            for source in sources:
+                yield serialize_source(*source)
+
+    def iter_source_data(self):
+        """Yields (file_path, line_ends, coded_lines) for each document, where 
+        line_ends holds the character offset at which each line ends, and 
+        coded_lines is a list of (code, coder, line). 
+        Documents and coded lines are each fetched with a single query ordered 
+        by file path, and merged. Line offsets are read from the database where 
+        available; any which need to be computed are stored when the export 
+        completes, if the database can be written.
         """
-        lines = []
-        index = 0
-        with (self.corpus.corpus_dir / corpus_file_path).open() as fh:
-            for line in fh:
-                start = index
-                end = index + len(line)
-                lines.append((start, end))
-                index += len(line)
-        return lines
+        with self.corpus.session():
+            coded_lines = self.corpus.iter_coded_lines()
+            coded_lines_by_doc = groupby(coded_lines, key=itemgetter(3))
+            doc_path, rows = next(coded_lines_by_doc, (None, None))
+            for doc in self.corpus.iter_documents(line_offsets=True):
+                line_ends = self.corpus.document_line_offsets(doc, characters=True)
+                doc_coded_lines = []
+                while doc_path is not None and doc_path <= doc.file_path:
+                    if doc_path == doc.file_path:
+                        doc_coded_lines = [row[:3] for row in rows]
+                    doc_path, rows = next(coded_lines_by_doc, (None, None))
+                yield doc.file_path, line_ends, doc_coded_lines
+            self.corpus.commit_cache()
 
     def coder_guid(self, coder):
-        return self.guid(coder)
+        return coder_guid(coder)
 
     def coding_guid(self, code, coder, line, file_path):
-        return self.guid(':'.join([file_path, str(line), coder, code]))
+        return coding_guid(code, coder, line, file_path)
 
     def selection_guid(self, file_path, line):
-        return self.guid(f"{file_path}:{line}")
+        return selection_guid(file_path, line)
 
     def code_guid(self, code):
-        return self.guid(code)
+        return code_guid(code)
 
     def guid(self, source):
-        digest = md5(source.encode('utf8')).hexdigest()[:16]
-        return str(UUID(bytes=digest.encode('utf8')))
+        return guid(source)
+
+# Serialization of sources is done by module-level functions so that it can be 
+# run in worker processes. Each worker receives the code guids once, when it starts.
+code_guids = {}
+
+def set_code_guids(guids):
+    global code_guids
+    code_guids = guids
+
+def serialize_source(file_path, line_ends, coded_lines):
+    """Returns a serialized TextSource element for a document. 
+    line_ends holds the character offset at which each line ends; coded_lines 
+    is a list of (code, coder, line), ordered by line.
+    """
+    source = Element("TextSource")
+    source.set("plainTextPath", "internal://" + internal_path(file_path))
+    source.set("guid", guid(file_path))
+    source.set("name", file_path)
+    for line, cls in groupby(coded_lines, key=itemgetter(2)):
+        selection = Element("PlainTextSelection")
+        selection.set("guid", selection_guid(file_path, line))
+        selection.set("name", f"line:{line}")
+        selection.set("startPosition", str(line_ends[line - 1] if line > 0 else 0))
+        selection.set("endPosition", str(line_ends[line]))
+        for code, coder, line in cls:
+            coding = Element("Coding")
+            coding.set("guid", coding_guid(code, coder, line, file_path))
+            coding.set("creatingUser", coder_guid(coder))
+            code_ref = Element("CodeRef")
+            code_ref.set("targetGUID", code_guids[code])
+            coding.append(code_ref)
+            selection.append(coding)
+        source.append(selection)
+    return tostring(source, encoding="unicode")
+
+def internal_path(file_path):
+    "Returns the path of a source within the archive's sources directory"
+    return str(Path(guid(file_path)).with_suffix(Path(file_path).suffix))
+
+def coder_guid(coder):
+    return guid(coder)
+
+def coding_guid(code, coder, line, file_path):
+    return guid(':'.join([file_path, str(line), coder, code]))
+
+def selection_guid(file_path, line):
+    return guid(f"{file_path}:{line}")
+
+def code_guid(code):
+    return guid(code)
+
+def guid(source):
+    digest = md5(source.encode('utf8')).hexdigest()[:16]
+    return str(UUID(bytes=digest.encode('utf8')))
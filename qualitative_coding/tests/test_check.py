@@ -1,6 +1,8 @@
 from tests.fixtures import QCTestCase
 from pathlib import Path
-from qualitative_coding.corpus import DEFAULT_SETTINGS
+import os
+from qualitative_coding.corpus import QCCorpus, DEFAULT_SETTINGS
+from sqlalchemy import text
 
 class TestCheck(QCTestCase):
     def test_check_passes_when_no_errors(self):
@@ -30,5 +32,33 @@ class TestCheck(QCTestCase):
         message = self.run_in_testpath("qc check").stderr
         self.assertTrue("macbeth.txt" in message)
 
+    def test_check_validates_database_profile(self):
+        self.update_settings('database_profile', 'turbo')
+        message = self.run_in_testpath("qc check").stderr
+        self.assertTrue("Unrecognized database_profile preset turbo" in message)
+
+    def test_database_profile_applies_pragmas(self):
+        self.update_settings('database_profile', {'preset': 'fast', 'cache_size': -1234})
+        corpus = QCCorpus(self.testpath / "settings.yaml")
+        with corpus.engine.connect() as conn:
+            self.assertEqual(conn.execute(text("PRAGMA journal_mode")).scalar(), "wal")
+            self.assertEqual(conn.execute(text("PRAGMA cache_size")).scalar(), -1234)
 
+    def test_check_full_rehashes_files_with_unchanged_stat(self):
+        self.run_in_testpath("qc corpus import macbeth.txt --importer verbatim")
+        path = self.testpath / "corpus" / "macbeth.txt"
+        old_mtime_ns = path.stat().st_mtime_ns - 10**12
+        os.utime(path, ns=(old_mtime_ns, old_mtime_ns))
+        self.assertEqual(self.run_in_testpath("qc check").returncode, 0)
+        path.write_text(path.read_text().replace("Tomorrow", "Tonight!"))
+        os.utime(path, ns=(old_mtime_ns, old_mtime_ns))
+        self.assertEqual(self.run_in_testpath("qc check").returncode, 0)
+        message = self.run_in_testpath("qc check --full").stderr
+        self.assertTrue("macbeth.txt has been changed" in message)
 
+    def test_check_with_readonly_database_profile(self):
+        self.run_in_testpath("qc corpus import macbeth.txt --importer verbatim")
+        os.utime(self.testpath / "corpus" / "macbeth.txt", (1577836800, 1577836800))
+        self.update_settings('database_profile', 'readonly-analytics')
+        result = self.run_in_testpath("qc check")
+        self.assertEqual(result.returncode, 0, result.stderr)
@@ -1,6 +1,7 @@
 from tests.fixtures import QCTestCase
 from pathlib import Path
 from qualitative_coding.corpus import QCCorpus
+from qualitative_coding.exceptions import QCError
 
 class TestCode(QCTestCase):
 
@@ -17,6 +18,19 @@ class TestCode(QCTestCase):
         self.assertEqual(code_counts.get('one'), 1)
         self.assertFileDoesNotExist("codes.txt")
 
+    def test_recoding_replaces_coded_lines(self):
+        self.run_in_testpath("qc code chris")
+        with self.corpus.session():
+            self.corpus.update_coded_lines("macbeth.txt", "chris", [
+                {'line': 0, 'code_id': 'line'},
+                {'line': 4, 'code_id': 'candle'},
+            ])
+            code_counts = self.corpus.count_codes()
+            paragraphs = self.corpus.get_coded_paragraphs(codes=['candle'])
+        self.assertEqual(code_counts, {'line': 1, 'candle': 1})
+        self.assertEqual(len(paragraphs), 1)
+        self.assertTrue('candle' in (self.testpath / "codebook.yaml").read_text())
+
     def test_code_saves_state_on_crash(self):
         self.set_mock_editor(verbose=True, crash=True)
         self.run_in_testpath("qc code chris")
@@ -52,7 +66,9 @@ class TestCode(QCTestCase):
         (self.testpath / "codes.txt").write_text('a')
         result = self.run_in_testpath("qc code chris --abandon")
 
-
-
-
-
+    def test_coding_unknown_document_raises_qc_error(self):
+        with self.corpus.session():
+            with self.assertRaises(QCError):
+                self.corpus.update_coded_lines("nonexistent.txt", "chris", [
+                    {'line': 0, 'code_id': 'one'}
+                ])
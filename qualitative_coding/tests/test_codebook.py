@@ -14,5 +14,22 @@ class TestCodebook(QCTestCase):
         cb = yaml.safe_load((self.testpath / "codebook.yaml").read_text())
         self.assertEqual(len(cb), 3)
 
+    def test_codebook_is_not_rewritten_without_new_codes(self):
+        self.run_in_testpath("qc corpus import macbeth.txt --importer verbatim")
+        self.set_mock_editor()
+        self.run_in_testpath("qc code chris")
+        codebook = "# Hand-edited\n- one\n- two\n- line\n"
+        (self.testpath / "codebook.yaml").write_text(codebook)
+        self.run_in_testpath("qc codebook")
+        self.assertEqual((self.testpath / "codebook.yaml").read_text(), codebook)
 
-
+    def test_reapplied_code_is_restored_to_codebook(self):
+        self.run_in_testpath("qc corpus import macbeth.txt --importer verbatim")
+        with self.corpus.session():
+            self.corpus.update_coded_lines("macbeth.txt", "chris", [{'line': 1, 'code_id': 'foo'}])
+            self.corpus.update_coded_lines("macbeth.txt", "chris", [])
+        (self.testpath / "codebook.yaml").write_text("")
+        with self.corpus.session():
+            self.corpus.update_coded_lines("macbeth.txt", "chris", [{'line': 1, 'code_id': 'foo'}])
+        cb = yaml.safe_load((self.testpath / "codebook.yaml").read_text())
+        self.assertEqual(cb, ['foo'])
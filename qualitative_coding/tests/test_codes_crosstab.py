@@ -17,3 +17,32 @@ class TestCrosstab(QCTestCase):
         result = self.run_in_testpath("qc codes crosstab one two line --probs --format tsv")
         table = self.read_stats_tsv(result.stdout)
         self.assertEqual(table['line']['two'], 0.5)
+
+    def test_crosstab_counts_cooccurrence_within_unit(self):
+        self.run_in_testpath("qc corpus import macbeth.txt --importer verbatim")
+        self.set_mock_editor()
+        self.run_in_testpath("qc code chris")
+        result = self.run_in_testpath("qc codes crosstab one two --unit line --format tsv")
+        table = self.read_stats_tsv(result.stdout)
+        self.assertEqual(table['one']['two'], 0)
+        result = self.run_in_testpath("qc codes crosstab one two --unit document --format tsv")
+        table = self.read_stats_tsv(result.stdout)
+        self.assertEqual(table['one']['two'], 1)
+
+    def test_crosstab_counts_distinct_units(self):
+        self.run_in_testpath("qc corpus import macbeth.txt --importer verbatim")
+        with self.corpus.session():
+            self.corpus.update_coded_lines("macbeth.txt", "chris", [
+                {'line': 0, 'code_id': 'A'}, 
+                {'line': 1, 'code_id': 'B'},
+            ])
+            self.corpus.update_coded_lines("macbeth.txt", "kate", [{'line': 0, 'code_id': 'A'}])
+            expected = {
+                'line': [[1, 0], [0, 1]],
+                'paragraph': [[1, 1], [1, 1]],
+                'document': [[1, 1], [1, 1]],
+            }
+            for unit, matrix in expected.items():
+                labels, cooccurrences = self.corpus.get_code_matrix(['A', 'B'], unit=unit)
+                self.assertEqual(labels, ['A', 'B'])
+                self.assertEqual(cooccurrences.tolist(), matrix, unit)
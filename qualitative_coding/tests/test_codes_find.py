@@ -1,3 +1,7 @@
+import os
+import json
+from sqlalchemy import update
+from qualitative_coding.database.models import Document
 from tests.fixtures import QCTestCase
 
 class TestFind(QCTestCase):
@@ -15,4 +19,20 @@ class TestFind(QCTestCase):
         result = self.run_in_testpath("qc codes find one -C 5")
         self.assertEqual(len(result.stdout.splitlines()), 11)
 
+    def test_find_jsonl_matches_json(self):
+        records = json.loads(self.run_in_testpath("qc codes find line --json").stdout)
+        result = self.run_in_testpath("qc codes find line --jsonl")
+        streamed = [json.loads(line) for line in result.stdout.splitlines()]
+        self.assertEqual(len(streamed), 2)
+        self.assertEqual(streamed, records)
 
+    def test_find_with_readonly_database_profile(self):
+        os.utime(self.testpath / "corpus" / "macbeth.txt", (0, 0))
+        self.run_in_testpath("qc check")
+        with self.corpus.session():
+            self.corpus.get_session().execute(update(Document).values(line_offsets=None))
+            self.corpus.get_session().commit()
+        self.update_settings('database_profile', 'readonly-analytics')
+        result = self.run_in_testpath("qc codes find line --jsonl")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(len(result.stdout.splitlines()), 2)
@@ -19,3 +19,21 @@ class TestRename(QCTestCase):
         self.run_in_testpath("qc codes rename line one")
         with corpus.session():
             self.assertEqual(len(corpus.get_coded_lines()), 3)
+
+    def test_rename_merges_old_codes_on_same_line(self):
+        corpus = QCCorpus(self.testpath/"settings.yaml")
+        self.run_in_testpath("qc codes rename line two three")
+        with corpus.session():
+            coded_lines = {(cl.line, cl.code_id) for cl in corpus.get_coded_lines()}
+        self.assertEqual(coded_lines, {(0, 'three'), (0, 'one'), (1, 'three')})
+
+    def test_rename_respects_coder_filter(self):
+        self.run_in_testpath("qc code other")
+        corpus = QCCorpus(self.testpath/"settings.yaml")
+        self.run_in_testpath("qc codes rename line pace --coders other")
+        with corpus.session():
+            chris = {cl.code_id for cl in corpus.get_coded_lines(coders=['chris'])}
+            other = {cl.code_id for cl in corpus.get_coded_lines(coders=['other'])}
+        self.assertIn('line', chris)
+        self.assertNotIn('line', other)
+        self.assertIn('pace', other)
@@ -1,5 +1,18 @@
 from tests.fixtures import QCTestCase
 from qualitative_coding.corpus import QCCorpus
+from qualitative_coding.cli.corpus.anonymize import (
+    generate_key_file,
+    replace_keys,
+    ner_pipe_names,
+)
+from unittest import TestCase
+from tempfile import TemporaryDirectory
+from pathlib import Path
+from qualitative_coding.database.models import EntityCache
+from sqlalchemy import select
+from unittest.mock import patch
+from structlog import get_logger
+import spacy
 import yaml
 
 NEWS = """A "hefty sneeze" has caused a professional footballer to sustain a 
@@ -45,5 +58,145 @@ class TestCorpusAnonymize(QCTestCase):
         anon_news = (self.testpath / "anonymized" / "news.txt").read_text()
         self.assertTrue("Adeboyejo" not in anon_news)
 
+    def test_caches_entities_by_file_hash(self):
+        with self.corpus.session():
+            doc = self.corpus.get_document(self.testpath / "corpus" / "news.txt")
+            cached = self.corpus.get_cached_entities([doc.file_hash])
+        self.assertIn(("PERSON", "Victor Adeboyejo"), cached[doc.file_hash])
 
+    def test_replaces_keys_in_a_single_pass(self):
+        keyfile = self.testpath / "key.yaml"
+        keyfile.write_text(yaml.dump({
+            "Bolton Wanderers": "Organization_1",
+            "Organization": "Bolton",
+            "(Ian)": "X",
+        }))
+        self.run_in_testpath("qc corpus anonymize")
+        anon_news = (self.testpath / "anonymized" / "news.txt").read_text()
+        self.assertIn("a striker for Organization_1,", anon_news)
+
+class TestKeyGeneration(QCTestCase):
+    """Generates keys using a blank spacy pipeline with an entity ruler in place of
+    the language model.
+    """
+    def setUp(self):
+        super().setUp()
+        (self.testpath / "news.txt").write_text(NEWS)
+        self.run_in_testpath("qc corpus import news.txt --importer verbatim")
+        self.processed = []
+
+    def language_model(self):
+        nlp = spacy.blank("en")
+        ruler = nlp.add_pipe("entity_ruler", name="ner")
+        ruler.add_patterns([
+            {"label": "PERSON", "pattern": "Victor Adeboyejo"},
+            {"label": "PERSON", "pattern": "Ian Evatt"},
+            {"label": "ORG", "pattern": "Bolton Wanderers"},
+            {"label": "DATE", "pattern": "Tuesday"},
+        ])
+        nlp.add_pipe("sentencizer")
+        pipe = nlp.pipe
+        def record_pipe(texts, as_tuples=False, **kwargs):
+            if as_tuples:
+                texts = list(texts)
+                self.processed += [text for text, context in texts]
+            return pipe(texts, as_tuples=as_tuples, **kwargs)
+        nlp.pipe = record_pipe
+        return nlp
+
+    def generate_key_file(self, corpus=None):
+        corpus = corpus or self.corpus
+        nlp = self.language_model()
+        with patch("spacy.util.is_package", return_value=True), \
+                patch("spacy.load", return_value=nlp):
+            with corpus.session():
+                docs = corpus.get_documents()
+                generate_key_file(self.testpath / "key.yaml", corpus, docs, get_logger())
+        return nlp
+
+    def read_keys(self):
+        return yaml.safe_load((self.testpath / "key.yaml").read_text())
+
+    def test_generates_keys_from_named_entities(self):
+        nlp = self.generate_key_file()
+        self.assertEqual(self.read_keys(), {
+            "Bolton Wanderers": "Organization_1",
+            "Ian Evatt": "Person_1",
+            "Victor Adeboyejo": "Person_2",
+        })
+        self.assertEqual(nlp.disabled, ["sentencizer"])
+
+    def test_only_processes_new_documents(self):
+        self.generate_key_file()
+        self.assertEqual(len(self.processed), 1)
+        (self.testpath / "key.yaml").unlink()
+        self.generate_key_file()
+        self.assertEqual(len(self.processed), 1)
+        self.assertEqual(len(self.read_keys()), 3)
+        (self.testpath / "more_news.txt").write_text("Ian Evatt met Victor Adeboyejo.\n")
+        self.run_in_testpath("qc corpus import more_news.txt --importer verbatim")
+        self.generate_key_file()
+        self.assertEqual(len(self.processed), 2)
+        self.assertEqual(len(self.read_keys()), 3)
+
+    def test_generates_keys_with_readonly_database(self):
+        corpus = QCCorpus(self.testpath / "settings.yaml", database_profile="readonly-analytics")
+        self.generate_key_file(corpus)
+        self.assertEqual(len(self.read_keys()), 3)
+        with self.corpus.session():
+            cached = self.corpus.get_session().scalars(select(EntityCache)).all()
+        self.assertEqual(cached, [])
+
+class TestNerPipeNames(TestCase):
+    def language_model(self, ner_config):
+        nlp = spacy.blank("en")
+        nlp.add_pipe("tok2vec")
+        nlp.add_pipe("ner", config=ner_config)
+        nlp.add_pipe("sentencizer")
+        return nlp
+
+    def test_omits_tok2vec_when_ner_has_its_own_embedding(self):
+        nlp = self.language_model({})
+        self.assertEqual(ner_pipe_names(nlp), {"ner"})
+
+    def test_includes_tok2vec_when_ner_listens_to_it(self):
+        nlp = self.language_model({"model": {
+            "@architectures": "spacy.TransitionBasedParser.v2", 
+            "state_type": "ner",
+            "extra_state_tokens": False, 
+            "hidden_width": 64, 
+            "maxout_pieces": 2, 
+            "use_upper": True,
+            "tok2vec": {"@architectures": "spacy.Tok2VecListener.v1", "width": 96, "upstream": "*"},
+        }})
+        self.assertEqual(ner_pipe_names(nlp), {"tok2vec", "ner"})
+
+class TestReplaceKeys(TestCase):
+    def replace(self, keys, text):
+        with TemporaryDirectory() as tempdir:
+            source, dest = Path(tempdir) / "source.txt", Path(tempdir) / "dest.txt"
+            source.write_text(text)
+            replace_keys(keys, source, dest)
+            return dest.read_text()
+
+    def test_prefers_longest_key_at_each_position(self):
+        keys = {"Ann": "P1", "Ann Lee": "P2", "Lee": "P3", "nn L": "X"}
+        self.assertEqual(self.replace(keys, "Ann Lee and Ann, Lee."), "P2 and P1, P3.")
+
+    def test_leftmost_key_wins_when_keys_overlap(self):
+        keys = {"ab": "1", "bcd": "2"}
+        self.assertEqual(self.replace(keys, "abcd bcd"), "1cd 2")
+
+    def test_keys_may_contain_regex_metacharacters(self):
+        keys = {"A.B": "1", "(c)": "2", "d*": "3", "e\\f": "4"}
+        text = "A.B AxB (c) c d* dd e\\f"
+        self.assertEqual(self.replace(keys, text), "1 AxB 2 c 3 dd 4")
+
+    def test_does_not_replace_within_placeholders(self):
+        keys = {"Bolton Wanderers": "Organization_1", "Organization": "Bolton"}
+        text = "Bolton Wanderers is an Organization."
+        self.assertEqual(self.replace(keys, text), "Organization_1 is an Bolton.")
 
+    def test_empty_keys_leave_text_unchanged(self):
+        self.assertEqual(self.replace({}, "Ann Lee"), "Ann Lee")
+        self.assertEqual(self.replace({"": "X"}, "Ann Lee"), "Ann Lee")
@@ -50,6 +50,19 @@ class TestImport(QCTestCase):
         self.assertFileImported("one.txt")
         self.assertFileImported("preface/note.txt")
 
+    def test_import_recursive_in_parallel_collects_errors(self):
+        (self.testpath / "chapters").mkdir()
+        (self.testpath / "chapters/one.txt").write_text("one")
+        (self.testpath / "chapters/two.txt").write_text("two")
+        (self.testpath / "chapters/bad.txt").write_bytes(b"\xff\xfe\xfa")
+        result = self.run_in_testpath(
+                "qc corpus import chapters --recursive --importer verbatim --jobs 2")
+        self.assertNotEqual(result.returncode, 0)
+        self.assertTrue("bad.txt" in result.stderr)
+        self.assertFileImported("one.txt")
+        self.assertFileImported("two.txt")
+        self.assertFileDoesNotExist("corpus/bad.txt")
+
     def assertFileImported(self, path):
         self.assertFileExists(Path("corpus") / path)
         with self.corpus.session():
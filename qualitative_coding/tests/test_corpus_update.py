@@ -1,5 +1,10 @@
+from subprocess import run
+from unittest.mock import patch
+from qualitative_coding.exceptions import QCError
 from tests.fixtures import QCTestCase
 from qualitative_coding.corpus import QCCorpus
+from qualitative_coding.database.models import CodedLine, Location
+from sqlalchemy import select
 
 MACBETH_IMPROVED = """Tomorrow, and tomorrow, and tomorrow,
 Tomorrow, and tomorrow, and tomorrow,
@@ -50,5 +55,75 @@ class TestCorpusUpdate(QCTestCase):
             new_hash = self.corpus.get_document(self.testpath / "corpus/macbeth.txt").file_hash
         self.assertNotEqual(old_hash, new_hash)
 
+    def test_corpus_update_reindexes_coded_lines(self):
+        self.run_in_testpath("qc corpus update corpus/macbeth.txt --new macbeth_improved.txt")
+        with self.corpus.session():
+            coded_lines = self.corpus.get_coded_lines()
+            paragraphs = self.corpus.get_paragraph_locations("macbeth.txt")
+        self.assertEqual(sorted((line, code) for code, coder, line, f in coded_lines), [
+            (3, 'tomorrow'),
+            (4, 'creeps'),
+            (5, 'and'),
+            (6, 'the'),
+            (7, 'lifes'),
+            (8, 'and'),
+            (9, 'told'),
+        ])
+        self.assertEqual([(start, end) for start, end, loc_id in paragraphs], [(0, 10)])
+
+    def test_corpus_update_to_empty_file(self):
+        (self.testpath / "empty.txt").write_text("")
+        result = self.run_in_testpath("qc corpus update corpus/macbeth.txt --new empty.txt")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual((self.testpath / "corpus/macbeth.txt").read_text(), "")
+        with self.corpus.session():
+            session = self.corpus.get_session()
+            self.assertEqual(session.scalars(select(CodedLine)).all(), [])
+            self.assertEqual(session.scalars(select(Location)).all(), [])
+            self.assertEqual(self.corpus.get_paragraph_locations("macbeth.txt"), [])
+
+    def test_corpus_update_from_new_dir(self):
+        (self.testpath / "new_versions").mkdir()
+        (self.testpath / "new_versions/macbeth.txt").write_text(MACBETH_IMPROVED)
+        self.run_in_testpath("qc corpus update --new-dir new_versions")
+        self.assertEqual((self.testpath / "corpus/macbeth.txt").read_text(), MACBETH_IMPROVED)
+        with self.corpus.session():
+            coded_lines = self.corpus.get_coded_lines()
+        self.assertEqual(sorted(line for code, coder, line, f in coded_lines), [3, 4, 5, 6, 7, 8, 9])
 
+    def test_corpus_update_from_git_range(self):
+        git = ["git", "-c", "user.name=qc", "-c", "user.email=qc@example.com"]
+        run(git + ["init", "-q"], cwd=self.testpath, check=True)
+        run(git + ["add", "corpus"], cwd=self.testpath, check=True)
+        run(git + ["commit", "-qm", "original"], cwd=self.testpath, check=True)
+        (self.testpath / "corpus/macbeth.txt").write_text(MACBETH_IMPROVED)
+        run(git + ["commit", "-qam", "corrected"], cwd=self.testpath, check=True)
+        self.run_in_testpath("qc corpus update --git-range HEAD~1..HEAD")
+        with self.corpus.session():
+            coded_lines = self.corpus.get_coded_lines()
+            doc = self.corpus.get_document(self.testpath / "corpus/macbeth.txt")
+            self.assertEqual(doc.file_hash, self.corpus.hash_file(self.testpath / "corpus/macbeth.txt"))
+        self.assertEqual(sorted(line for code, coder, line, f in coded_lines), [3, 4, 5, 6, 7, 8, 9])
 
+    def test_failed_batch_update_leaves_corpus_unchanged(self):
+        self.run_in_testpath("qc corpus import moby_dick.md --importer verbatim")
+        (self.testpath / "new_versions").mkdir()
+        (self.testpath / "new_versions/macbeth.txt").write_text(MACBETH_IMPROVED)
+        (self.testpath / "new_versions/moby_dick.txt").write_text("Call me Ishmael.\n")
+        original_text = (self.testpath / "corpus/macbeth.txt").read_text()
+        reindex_document = self.corpus.reindex_document
+        def fail_on_moby_dick(corpus_path, *args, **kwargs):
+            if corpus_path == "moby_dick.txt":
+                raise QCError("Simulated failure")
+            return reindex_document(corpus_path, *args, **kwargs)
+        with self.corpus.session():
+            old_hash = self.corpus.get_document(self.testpath / "corpus/macbeth.txt").file_hash
+            with patch.object(self.corpus, "reindex_document", fail_on_moby_dick):
+                with self.assertRaises(QCError):
+                    self.corpus.update_documents(new_dir=self.testpath / "new_versions")
+        self.assertEqual((self.testpath / "corpus/macbeth.txt").read_text(), original_text)
+        self.assertEqual(sorted(p.name for p in (self.testpath / "corpus").iterdir()), 
+                ["macbeth.txt", "moby_dick.txt"])
+        with self.corpus.session():
+            doc = self.corpus.get_document(self.testpath / "corpus/macbeth.txt")
+            self.assertEqual(doc.file_hash, old_hash)
@@ -0,0 +1,47 @@
+from unittest import TestCase
+from qualitative_coding.document_reader import DocumentReader
+from tempfile import TemporaryDirectory
+from pathlib import Path
+
+class TestDocumentReader(TestCase):
+    def test_reads_same_lines_as_text_mode(self):
+        with TemporaryDirectory() as tempdir:
+            path = Path(tempdir) / "doc.txt"
+            for case in CASES:
+                path.write_bytes(case.encode())
+                with open(path) as fh:
+                    lines = [line for line in fh]
+                with DocumentReader(path) as reader:
+                    self.assertEqual(len(reader), len(lines))
+                    for start in range(len(lines) + 1):
+                        for stop in range(start, len(lines) + 2):
+                            self.assertEqual(reader.get_lines(start, stop), lines[start:stop])
+
+    def test_counts_characters_as_text_mode(self):
+        with TemporaryDirectory() as tempdir:
+            path = Path(tempdir) / "doc.txt"
+            for case in CASES:
+                path.write_bytes(case.encode())
+                with open(path) as fh:
+                    lines = [line for line in fh]
+                ends = [len(''.join(lines[:i + 1])) for i in range(len(lines))]
+                with DocumentReader(path) as reader:
+                    self.assertEqual(reader.character_offsets().tolist(), ends)
+
+    def test_uses_given_line_offsets(self):
+        with TemporaryDirectory() as tempdir:
+            path = Path(tempdir) / "doc.txt"
+            path.write_text("one\ntwo\nthree\n")
+            offsets = DocumentReader.compute_line_offsets(path.read_bytes())
+            self.assertEqual(offsets.tolist(), [4, 8, 14])
+            with DocumentReader(path, offsets[:2]) as reader:
+                self.assertEqual(reader.get_lines(0, 5), ["one\n", "two\n"])
+
+CASES = [
+    "",
+    "one line",
+    "one\ntwo\n\nfour\n",
+    "windows\r\nline endings\r\n",
+    "ünïcode\nwithout trailing newline",
+    "mixed €\r\nendings 𝄞\nin one file\r\n",
+]
@@ -1,5 +1,9 @@
+import os
 from qualitative_coding.tests.fixtures import QCTestCase
 from pathlib import Path
+from zipfile import ZipFile
+from sqlalchemy import update
+from qualitative_coding.database.models import Document
 
 class TestExport(QCTestCase):
     def test_creates_qdpx_file(self):
@@ -9,3 +13,35 @@ class TestExport(QCTestCase):
         self.run_in_testpath("qc code haley")
         self.run_in_testpath("qc export out.qdpx")
         self.assertFileExists("out.qdpx")
+
+    def test_incremental_export_reuses_sources(self):
+        self.run_in_testpath("qc corpus import macbeth.txt --importer verbatim")
+        self.set_mock_editor(verbose=True)
+        self.run_in_testpath("qc code chris")
+        self.run_in_testpath("qc export out.qdpx")
+        with ZipFile(self.testpath / "out.qdpx") as zf:
+            before = {info.filename: (info.CRC, info.comment) for info in zf.infolist()}
+        self.run_in_testpath("qc code haley")
+        self.run_in_testpath("qc export out.qdpx --incremental")
+        with ZipFile(self.testpath / "out.qdpx") as zf:
+            self.assertIsNone(zf.testzip())
+            after = {info.filename: (info.CRC, info.comment) for info in zf.infolist()}
+        sources = [name for name in after if name.startswith("sources/")]
+        self.assertEqual(len(sources), 1)
+        self.assertEqual(after[sources[0]], before[sources[0]])
+        self.assertTrue(after[sources[0]][1])
+        self.assertNotEqual(after["project.qde"], before["project.qde"])
+
+    def test_export_with_readonly_database_profile(self):
+        self.run_in_testpath("qc corpus import macbeth.txt --importer verbatim")
+        self.set_mock_editor(verbose=True)
+        self.run_in_testpath("qc code chris")
+        os.utime(self.testpath / "corpus" / "macbeth.txt", (1577836800, 1577836800))
+        self.run_in_testpath("qc check")
+        with self.corpus.session():
+            self.corpus.get_session().execute(update(Document).values(line_offsets=None))
+            self.corpus.get_session().commit()
+        self.update_settings('database_profile', 'readonly-analytics')
+        result = self.run_in_testpath("qc export out.qdpx")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertFileExists("out.qdpx")
@@ -3,6 +3,8 @@ from qualitative_coding.corpus import QCCorpus
 from tempfile import TemporaryDirectory
 from pathlib import Path
 from subprocess import run
+from zipfile import ZipFile
+import re
 
 class TestInitImport(QCTestCase):
     def test_imports_from_qdpx_file(self):
@@ -25,3 +27,44 @@ class TestInitImport(QCTestCase):
                 self.assertEqual(len(list(corpus.get_all_coders())), 2)
                 self.assertEqual(len(corpus.get_coded_lines()), 8)
 
+
+    def test_imports_sources_in_subdirectories(self):
+        self.run_in_testpath("qc corpus import macbeth.txt --importer verbatim --corpus-root plays")
+        self.set_mock_editor(verbose=True)
+        self.run_in_testpath("qc code chris")
+        self.run_in_testpath("qc export out.qdpx")
+        with self.corpus.session():
+            coded_lines = sorted(self.corpus.get_coded_lines())
+        with TemporaryDirectory() as outdir:
+            qdxp_file = self.testpath / "out.qdpx"
+            run(f'qc init --import "{qdxp_file}"', cwd=outdir, shell=True, 
+                    check=True, capture_output=True, text=True)
+            corpus = QCCorpus(Path(outdir) / "settings.yaml")
+            self.assertEqual(
+                (Path(outdir) / "corpus" / "plays" / "macbeth.txt").read_bytes(),
+                (self.testpath / "corpus" / "plays" / "macbeth.txt").read_bytes(),
+            )
+            self.assertFalse((Path(outdir) / "source").exists())
+            with corpus.session():
+                self.assertEqual(sorted(corpus.get_coded_lines()), coded_lines)
+
+    def test_maps_selection_positions_to_lines(self):
+        self.run_in_testpath("qc corpus import macbeth.txt --importer verbatim")
+        self.set_mock_editor(verbose=True)
+        self.run_in_testpath("qc code chris")
+        self.run_in_testpath("qc export out.qdpx")
+        with self.corpus.session():
+            coded_lines = sorted(self.corpus.get_coded_lines())
+        qdpx_file = self.testpath / "positions.qdpx"
+        with ZipFile(self.testpath / "out.qdpx") as src, ZipFile(qdpx_file, 'w') as dest:
+            for name in src.namelist():
+                data = src.read(name)
+                if name == "project.qde":
+                    data = re.sub(rb'name="line:\d+"', b'name="selection"', data)
+                dest.writestr(name, data)
+        with TemporaryDirectory() as outdir:
+            run(f'qc init --import "{qdpx_file}"', cwd=outdir, shell=True, 
+                    check=True, capture_output=True, text=True)
+            corpus = QCCorpus(Path(outdir) / "settings.yaml")
+            with corpus.session():
+                self.assertEqual(sorted(corpus.get_coded_lines()), coded_lines)
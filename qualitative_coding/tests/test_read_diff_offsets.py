@@ -1,6 +1,6 @@
 from difflib import unified_diff
 from unittest import TestCase
-from qualitative_coding.diff import read_diff_offsets
+from qualitative_coding.diff import read_diff_offsets, get_line_mapping
 
 doc0 = [t + '\n' for t in 'abcdefghijklmnop']
 doc1 = [t + '\n' for t in '1bcdef12lmnopqr']
@@ -11,3 +11,15 @@ class TestReadDiffOffsets(TestCase):
         expected = [(9, -3), (17, 2)]
         observed = read_diff_offsets(diff)
         self.assertEqual(expected, observed)
+
+    def test_read_diff_offsets_places_insertions_after_edited_lines(self):
+        old = [t + '\n' for t in 'abcdef']
+        new = [t + '\n' for t in 'aBCXdYf']
+        observed = read_diff_offsets(''.join(unified_diff(old, new, n=0)))
+        self.assertEqual(observed, [(4, 1)])
+
+    def test_get_line_mapping_maps_lines(self):
+        map_lines = get_line_mapping(read_diff_offsets(diff))
+        observed = map_lines(range(len(doc0))).tolist()
+        expected = [0, 1, 2, 3, 4, 5, 6, 7, -1, -1, -1, 8, 9, 10, 11, 12]
+        self.assertEqual(observed, expected)
@@ -3,6 +3,8 @@ from tests.fixtures import QCTestCase
 from qualitative_coding.refi_qda.writer import REFIQDAWriter
 from tempfile import TemporaryDirectory
 from xmlschema import validate
+from zipfile import ZipFile
+from xml.etree.ElementTree import fromstring
 import importlib.resources
 
 CODEBOOK = """
@@ -38,6 +40,36 @@ class TestREFIQDAWriter(QCTestCase):
             xml_path = project_path / "project.qde"
             self.writer.write_xml(xml_path)
             validate(xml_path, schema_path)
-            
+
+    def test_write_streams_sources_into_archive(self):
+        self.run_in_testpath("qc corpus import macbeth.txt --importer verbatim")
+        self.set_mock_editor(verbose=True)
+        self.run_in_testpath("qc code chris")
+        outpath = self.testpath / "out.qdpx"
+        self.writer.write(outpath)
+        with ZipFile(outpath) as zf:
+            sources = [name for name in zf.namelist() if name.startswith("sources/")]
+            self.assertEqual(len(sources), 1)
+            self.assertEqual(
+                zf.read(sources[0]), 
+                (self.testpath / "corpus" / "macbeth.txt").read_bytes()
+            )
+            qde = fromstring(zf.read("project.qde"))
+        self.assertEqual(len(qde.findall("{*}Sources/{*}TextSource")), 1)
 
 
+    def test_parallel_serialization_matches_serial(self):
+        self.run_in_testpath("qc corpus import macbeth.txt --importer verbatim")
+        self.set_mock_editor(verbose=True)
+        self.run_in_testpath("qc code chris")
+        serial_path = self.testpath / "serial.qde"
+        parallel_path = self.testpath / "parallel.qde"
+        self.writer.write_xml(serial_path)
+        REFIQDAWriter(self.testpath / "settings.yaml", jobs=2).write_xml(parallel_path)
+        self.assertEqual(serial_path.read_text(), parallel_path.read_text())
+        selection = fromstring(serial_path.read_text()).find(".//{*}PlainTextSelection")
+        with open(self.testpath / "corpus" / "macbeth.txt") as fh:
+            lines = fh.readlines()
+        line = int(selection.get("name").split(":")[1])
+        self.assertEqual(int(selection.get("startPosition")), len(''.join(lines[:line])))
+        self.assertEqual(int(selection.get("endPosition")), len(''.join(lines[:line + 1])))
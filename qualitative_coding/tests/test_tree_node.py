@@ -15,6 +15,43 @@ class TestTreeNode(TestCase):
                 TreeNode.write_yaml(outfile, tn)
                 self.assertEqual(outfile.read_text(), case)
 
+    def test_read_yaml_cache(self):
+        with TemporaryDirectory() as tempdir:
+            path = Path(tempdir) / "codebook.yaml"
+            path.write_text(FLAT_CODEBOOK)
+            tree = TreeNode.read_yaml(path)
+            tree.add_child("d four")
+            self.assertEqual(TreeNode.read_yaml(path).flatten(names=True), 
+                    ["a one", "b two", "c three"])
+            path.write_text(NESTED_CODEBOOK)
+            self.assertEqual(TreeNode.read_yaml(path).flatten(names=True), 
+                    ["a", "b", "c", "d", "one", "two"])
+
+    def test_index_matches_tree(self):
+        tree = TreeNode({TreeNode.root: yaml.safe_load(REPEATED_CODEBOOK)})
+        index = tree.index()
+        for depth in [None, 0, 1]:
+            self.assertEqual(index.flatten(depth=depth), tree.flatten(depth=depth))
+            self.assertEqual(
+                index.flatten(names=True, expanded=True, depth=depth), 
+                tree.flatten(names=True, expanded=True, depth=depth)
+            )
+        self.assertEqual(index.find('b'), tree.find('b'))
+        self.assertEqual(
+            index.flatten(index.find('c')[0], names=True),
+            ['b', 'c', 'd']
+        )
+        self.assertTrue(index.is_ancestor(tree.find('a')[0], tree.find('d')[0]))
+        self.assertFalse(index.is_ancestor(tree.find('e')[0], tree.find('d')[0]))
+
+    def test_expanded_names_follow_changes(self):
+        tree = TreeNode({TreeNode.root: yaml.safe_load(REPEATED_CODEBOOK)})
+        self.assertEqual(tree.find('d')[0].expanded_name(), 'a:c:d')
+        tree.rename('c', 'x')
+        self.assertEqual(tree.find('d')[0].expanded_name(), 'a:x:d')
+        tree.remove_children_by_name('x')
+        self.assertEqual(tree.find('d')[0].expanded_name(), 'a:d')
+
 EMPTY_CODEBOOK = "[]\n"
 FLAT_CODEBOOK = """- a one
 - b two
@@ -27,4 +64,13 @@ NESTED_CODEBOOK = """- one:
 - two:
   - d
 """
+REPEATED_CODEBOOK = """- a:
+  - b
+  - c:
+    - d
+    - b
+- e
+- f:
+  - b
+"""
 CASES = [EMPTY_CODEBOOK, FLAT_CODEBOOK, NESTED_CODEBOOK]
@@ -1,6 +1,7 @@
 from tests.fixtures import QCTestCase
 from qualitative_coding.corpus import QCCorpus
 from qualitative_coding.logs import configure_logger
+from sqlalchemy import text
 
 class TestUpgrade(QCTestCase):
     def setUp(self):
@@ -20,3 +21,21 @@ class TestUpgrade(QCTestCase):
         with corpus.session():
             code_counts = corpus.count_codes()
         self.assertEqual(code_counts['prolepsis'], 3)
+
+    def test_upgrade_1_4_0_to_1_8_0_adds_indexes(self):
+        self.set_up_qc_project()
+        self.run_in_testpath("qc upgrade -v 1.4.0")
+        self.assertEqual(self.get_index_names(), set())
+        result = self.run_in_testpath("qc upgrade")
+        self.assertTrue("ix_coded_line_coder_code_line" in self.get_index_names())
+        corpus = QCCorpus(self.testpath / "settings.yaml")
+        with corpus.session():
+            self.assertEqual(corpus.get_documents(), [])
+
+    def get_index_names(self):
+        corpus = QCCorpus(self.testpath / "settings.yaml", skip_validation=True)
+        with corpus.engine.connect() as conn:
+            rows = conn.execute(text(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_%'"
+            ))
+            return set(name for name, in rows)
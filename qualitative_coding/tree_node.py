@@ -1,10 +1,17 @@
 # An idiosyncratic implementation of nodes in a tree structure.
 # Could use refactoring
 
+import os
 import yaml
+from collections import defaultdict
 from functools import total_ordering
+from pathlib import Path
 from qualitative_coding.exceptions import CodebookParseError
 
+# Use libyaml's C implementation when PyYAML was built with it.
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
 @total_ordering
 class TreeNode:
     """
@@ -15,27 +22,55 @@ class TreeNode:
     indent = "    "
     list_marker = "- "
 
+    # Parsed codebooks, keyed by path and validated against (mtime_ns, size).
+    # Shared by all readers in the process.
+    yaml_cache = {}
+
     @classmethod
     def read_yaml(cls, filename):
-        with open(filename) as f:
-            try:
-                data = yaml.safe_load(f)
-                return TreeNode({cls.root: data})
-            except yaml.scanner.ScannerError as err:
-                m = err.problem_mark
-                message = f"Error reading {filename} on line {m.line}: {err.problem}"
-                raise CodebookParseError(message)
-            except yaml.parser.ParserError as err:
-                m = err.problem_mark
-                message = f"Error reading {filename} on line {m.line}: {err.problem}"
-                raise CodebookParseError(message)
+        """Reads a tree from a YAML file. 
+        Parsed data is cached until the file's mtime or size changes; each call 
+        returns a new tree, so callers may modify it freely.
+        """
+        path = Path(filename).resolve()
+        stat = path.stat()
+        cached = cls.yaml_cache.get(path)
+        if cached and cached[0] == (stat.st_mtime_ns, stat.st_size):
+            data = cached[1]
+        else:
+            with open(path) as f:
+                try:
+                    data = yaml.load(f, Loader=YamlLoader)
+                except yaml.scanner.ScannerError as err:
+                    m = err.problem_mark
+                    message = f"Error reading {filename} on line {m.line}: {err.problem}"
+                    raise CodebookParseError(message)
+                except yaml.parser.ParserError as err:
+                    m = err.problem_mark
+                    message = f"Error reading {filename} on line {m.line}: {err.problem}"
+                    raise CodebookParseError(message)
+            cls.yaml_cache[path] = ((stat.st_mtime_ns, stat.st_size), data)
+        return TreeNode({cls.root: data})
 
     @classmethod
     def write_yaml(cls, filename, tree_node):
-        with open(filename, 'w') as f:
-            f.write(yaml.dump(tree_node.to_json(), default_flow_style=False))
+        """Writes a tree to a YAML file. 
+        The tree is written to a temporary file which then replaces filename, 
+        so readers never see a partially-written codebook.
+        """
+        path = Path(filename)
+        cls.yaml_cache.pop(path.resolve(), None)
+        temp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        try:
+            with open(temp_path, 'w') as f:
+                f.write(yaml.dump(tree_node.to_json(), Dumper=YamlDumper, 
+                        default_flow_style=False))
+            os.replace(temp_path, path)
+        finally:
+            temp_path.unlink(missing_ok=True)
 
     def __init__(self, representation, parent=None):
+        self._expanded_name = None
         self.parent = parent
         if isinstance(representation, str):
             self.name = representation
@@ -46,6 +81,36 @@ class TreeNode:
         else:
             raise ValueError("Illegal node representation: {}".format(representation))
 
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
+        self.clear_expanded_names()
+
+    @property
+    def parent(self):
+        return self._parent
+
+    @parent.setter
+    def parent(self, parent):
+        self._parent = parent
+        self.clear_expanded_names()
+
+    def clear_expanded_names(self):
+        "Clears memoized expanded names of this node and its descendants"
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            node._expanded_name = None
+            stack += getattr(node, 'children', [])
+
+    def index(self):
+        "Returns an immutable TreeIndex of this node and its descendants"
+        return TreeIndex(self)
+
     def add_child(self, representation):
         self.children.append(TreeNode(representation, parent=self))
 
@@ -67,10 +132,12 @@ class TreeNode:
 
     def ancestors(self):
         "Returns a list of ancestors, ending with self"
-        if self.is_root() or self.is_root():
-            return []
-        else:
-            return self.parent.ancestors() + [self]
+        result = []
+        node = self
+        while not node.is_root():
+            result.append(node)
+            node = node.parent
+        return list(reversed(result))
 
     def depth(self):
         return len(self.ancestors())
@@ -92,10 +159,15 @@ class TreeNode:
         If expanded, return expanded name, like 'fruits:apples:pippin'
         If depth is not None, limits the depth of recursion
         """
-        result = [] if self.is_root() else [self]
-        if depth is None or depth > 0:
-            for child in self.children: 
-                result += child.flatten(depth=depth if depth is None else depth - 1)
+        result = []
+        stack = [(self, depth)]
+        while stack:
+            node, remaining = stack.pop()
+            if not node.is_root():
+                result.append(node)
+            if remaining is None or remaining > 0:
+                child_depth = None if remaining is None else remaining - 1
+                stack += [(child, child_depth) for child in reversed(node.children)]
         if names:
             if expanded:
                 result = [n.expanded_name(sep=sep) for n in result]
@@ -105,10 +177,14 @@ class TreeNode:
 
     def expanded_name(self, sep=":"):
         "Returns expanded name, like 'fruits:apples:pippin'"
-        if self.parent and not self.parent.is_root():
-            return self.parent.expanded_name(sep=sep) + sep + self.name
-        else:
-            return self.name
+        if sep != ":":
+            return sep.join(n.name for n in self.ancestors()) or self.name
+        if self._expanded_name is None:
+            if self.parent and not self.parent.is_root():
+                self._expanded_name = self.parent.expanded_name() + sep + self.name
+            else:
+                self._expanded_name = self.name
+        return self._expanded_name
 
     def indented_name(self, nodes, sep=":", indent_length=2, indent_start='.'):
         "Returns indented name, like '.    pippin'"
@@ -125,9 +201,13 @@ class TreeNode:
 
     def find(self, name):
         "Returns all child nodes (including self) with matching name"
-        result = [self] if self.name == name else []
-        for child in self.children:
-            result += child.find(name)
+        result = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.name == name:
+                result.append(node)
+            stack += reversed(node.children)
         return result
 
     def sum(self, prop):
@@ -177,3 +257,100 @@ class TreeNode:
     def __repr__(self):
         return "<{}>".format(self.name)
 
+class TreeIndex:
+    """
+    An immutable, array-backed snapshot of a tree of TreeNodes, for answering 
+    many queries against a large codebook. Nodes are stored in depth-first 
+    (pre-order) order, alongside arrays of parent positions, child positions, 
+    depths and expanded names, and an index from names to positions.
+    The descendants of the node at position i occupy positions i+1 through
+    end[i]-1 (its Euler-tour interval), so subtree queries are slices.
+    Changes made to the TreeNodes after the index is built are not reflected.
+    """
+    def __init__(self, root):
+        self.nodes = []
+        self.parents = []
+        self.children = []
+        self.depths = []
+        self.ends = []
+        self.expanded_names = []
+        self.positions = {}
+        self.by_name = defaultdict(list)
+        self.add_subtree(root, -1, 0)
+        rank = {name: r for r, name in enumerate(sorted(set(self.expanded_names)))}
+        self.ranks = [rank[name] for name in self.expanded_names]
+
+    def add_subtree(self, root, parent, depth):
+        "Adds nodes in pre-order, without recursion"
+        stack = [(root, parent, depth, False)]
+        while stack:
+            node, parent, depth, done = stack.pop()
+            if done:
+                self.ends[self.positions[id(node)]] = len(self.nodes)
+                continue
+            position = len(self.nodes)
+            self.nodes.append(node)
+            self.parents.append(parent)
+            self.children.append([])
+            self.depths.append(depth)
+            self.ends.append(None)
+            self.expanded_names.append("" if node.is_root() else node.expanded_name())
+            self.positions[id(node)] = position
+            self.by_name[node.name].append(position)
+            if parent >= 0:
+                self.children[parent].append(position)
+            stack.append((node, parent, depth, True))
+            stack += [(c, position, depth + 1, False) for c in reversed(node.children)]
+
+    def position(self, node):
+        "Returns the position of node in the index"
+        return self.positions[id(node)]
+
+    def find(self, name):
+        "Returns all nodes with matching name, in depth-first order"
+        return [self.nodes[i] for i in self.by_name.get(name, [])]
+
+    def subtree(self, node, depth=None):
+        "Returns positions of node and its descendants, up to depth levels below node"
+        i = self.position(node)
+        positions = range(i, self.ends[i])
+        if depth is not None:
+            max_depth = self.depths[i] + depth
+            positions = [j for j in positions if self.depths[j] <= max_depth]
+        return [j for j in positions if not self.nodes[j].is_root()]
+
+    def is_ancestor(self, ancestor, node):
+        "Checks whether ancestor is node or one of its ancestors"
+        i, j = self.position(ancestor), self.position(node)
+        return i <= j < self.ends[i]
+
+    def flatten(self, node=None, names=False, expanded=False, sep=":", depth=None):
+        """
+        Like TreeNode.flatten: returns node (by default, the root) and its 
+        children as a sorted list.
+        """
+        positions = self.subtree(self.nodes[0] if node is None else node, depth=depth)
+        if names:
+            if expanded and sep == ":":
+                return sorted(self.expanded_names[j] for j in positions)
+            elif expanded:
+                return sorted(self.nodes[j].expanded_name(sep=sep) for j in positions)
+            else:
+                return sorted(self.nodes[j].name for j in positions)
+        return [self.nodes[j] for j in sorted(positions, key=self.ranks.__getitem__)]
+
+    def select(self, codes=None, recursive_codes=False, depth=None):
+        """
+        Selects nodes as the CLI does: when codes are given, nodes matching any 
+        of the codes (and, if recursive_codes, their descendants up to depth); 
+        otherwise all nodes up to depth.
+        """
+        if codes:
+            nodes = [node for code in codes for node in self.find(code)]
+            if recursive_codes:
+                positions = set(j for n in nodes for j in self.subtree(n, depth=depth))
+                nodes = set(self.nodes[j] for j in positions)
+            return nodes
+        else:
+            return self.flatten(depth=depth)
+
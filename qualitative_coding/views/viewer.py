@@ -1,14 +1,16 @@
 from qualitative_coding.tree_node import TreeNode
+from qualitative_coding.document_reader import DocumentReader
 from qualitative_coding.helpers import prompt_for_choice
 from qualitative_coding.exceptions import QCError, CodeFileParseError
 from qualitative_coding.editors import editors
 from tabulate import tabulate
 from collections import defaultdict, Counter
+from operator import itemgetter
 from pathlib import Path
 from subprocess import run, CalledProcessError
 from datetime import datetime
 from random import choice
-from itertools import count
+from itertools import count, groupby
 from textwrap import fill
 import numpy as np
 import csv
@@ -71,12 +73,7 @@ class QCCorpusViewer:
                 coders=coders, 
                 unit=unit, 
             )
-        if codes:
-            nodes = sum([tree.find(c) for c in codes], [])
-            if recursive_codes:
-                nodes = set(sum([n.flatten(depth=depth) for n in nodes], []))
-        else:
-            nodes = tree.flatten(depth=depth)
+        nodes = tree.index().select(codes, recursive_codes=recursive_codes, depth=depth)
         if max_count != None:
             nodes = filter(lambda n: n.total <= max_count, nodes)
         if min_count != None:
@@ -84,12 +81,13 @@ class QCCorpusViewer:
         if not zeros:
             nodes = filter(lambda n: n.total > 0, nodes)
         nodes = sorted(nodes)
+        node_set = set(nodes)
 
         def namer(node):
             if expanded:
                 return node.expanded_name()
             elif recursive_codes and not outfile:
-                return node.indented_name(nodes)
+                return node.indented_name(node_set)
             else:
                 return node.name
 
@@ -172,34 +170,34 @@ class QCCorpusViewer:
         """Shows a table where each row is a document and each column
         is a coder.
         """
+        matrix = defaultdict(lambda: defaultdict(int))
         with self.corpus.session():
             if unit == 'line':
-                lines = self.corpus.get_coded_lines(
+                lines = self.corpus.iter_coded_lines(
                     codes=codes, 
                     pattern=pattern,
                     file_list=file_list,
                     coders=coders,
                 )
-                units = [(doc, coder) for _, coder, _, doc in lines]
+                units = ((doc, coder) for _, coder, _, doc in lines)
             elif unit == 'paragraph':
-                paragraphs = self.corpus.get_coded_paragraphs(
+                paragraphs = self.corpus.iter_coded_paragraphs(
                     codes=codes, 
                     pattern=pattern,
                     file_list=file_list,
                     coders=coders,
                 )
-                units = [(doc, coder) for _, coder, _, doc, _, _, _ in paragraphs]
+                units = ((doc, coder) for _, coder, doc, _, _ in paragraphs)
             elif unit == 'document':
-                docs = self.corpus.get_coded_paragraphs(
+                docs = self.corpus.iter_coded_documents(
                     codes=codes, 
                     pattern=pattern,
                     file_list=file_list,
                     coders=coders,
                 )
-                units = [(doc, coder) for _, coder, doc in docs]
-        matrix = defaultdict(lambda: defaultdict(int))
-        for doc, coder in units:
-            matrix[doc][coder] += 1
+                units = ((doc, coder) for _, coder, doc in docs)
+            for doc, coder in units:
+                matrix[doc][coder] += 1
         doc_index = sorted(matrix.keys())
         coder_index = set()
         for row in matrix.values():
@@ -326,9 +324,9 @@ class QCCorpusViewer:
     
     def get_child_nodes(self, code, names=False, expanded=False, depth=None):
         "Finds all children of the given code (which may occur multiple times in the code tree)"
-        code_tree = self.corpus.get_codebook()
-        matches = code_tree.find(code)
-        return sum([m.flatten(names=names, expanded=expanded, depth=depth) for m in matches], [])
+        code_tree = self.corpus.get_codebook().index()
+        return [child for match in code_tree.find(code) 
+                for child in code_tree.flatten(match, names=names, expanded=expanded, depth=depth)]
 
     def show_coded_text(self, codes, 
             recursive_codes=False, 
@@ -349,75 +347,72 @@ class QCCorpusViewer:
             codes = set(sum([self.get_child_nodes(code, names=True) for code in codes], []))
         else:
             codes = set(codes)
+        query_args = dict(codes=codes, pattern=pattern, file_list=file_list, coders=coders)
         if unit == "line": 
             with self.corpus.session():
-                coded_lines = self.corpus.get_coded_lines(codes=codes, pattern=pattern, 
-                        file_list=file_list, coders=coders)
-            doc_coded_lines = defaultdict(lambda: defaultdict(set))
-            doc_code_counts = defaultdict(int)
-            for code, coder, line_num, doc_path in coded_lines:
-                doc_code_counts[doc_path] += 1
-                doc_coded_lines[doc_path][line_num].add(code)
-            for doc_path, coded_lines in doc_coded_lines.items():
-                with open(self.corpus.corpus_dir / doc_path) as fh:
-                    lines = [line for line in fh]
-                ranges = self.merge_ranges(
-                    [range(n-before, n+after+1) for n in coded_lines.keys()], 
-                    clamp=[0, len(lines)]
-                )
-                print(f"\n{doc_path} ({doc_code_counts[doc_path]})")
-                print("=" * text_width)
-                for r in ranges:
-                    if show_line_numbers:
-                        print("[{}:{}]".format(r.start, r.stop))
-                    if show_codes:
-                        self.show_text_with_codes(
-                            [lines[i] for i in r],
-                            [doc_coded_lines[doc_path][i] for i in r],
-                            text_width=text_width,
-                        )
-                    else:
-                        self.show_text(
-                            [lines[i] for i in r],
-                            text_width=text_width,
+                coded_lines = self.corpus.iter_coded_lines(**query_args)
+                for doc_path, rows in groupby(coded_lines, key=itemgetter(3)):
+                    line_codes = defaultdict(set)
+                    code_count = 0
+                    for code, coder, line_num, _ in rows:
+                        code_count += 1
+                        line_codes[line_num].add(code)
+                    with self.read_document(doc_path) as reader:
+                        ranges = self.merge_ranges(
+                            [range(n-before, n+after+1) for n in line_codes.keys()], 
+                            clamp=[0, len(reader)]
                         )
-                    print("")
+                        print(f"\n{doc_path} ({code_count})")
+                        print("=" * text_width)
+                        for r in ranges:
+                            lines = reader.get_lines(r.start, r.stop)
+                            if show_line_numbers:
+                                print("[{}:{}]".format(r.start, r.stop))
+                            if show_codes:
+                                self.show_text_with_codes(
+                                    lines,
+                                    [line_codes[i] for i in r],
+                                    text_width=text_width,
+                                )
+                            else:
+                                self.show_text(
+                                    lines,
+                                    text_width=text_width,
+                                )
+                            print("")
         elif unit == "paragraph":
             with self.corpus.session():
-                coded_paragraphs = self.corpus.get_coded_paragraphs(codes=codes, 
-                        pattern=pattern, file_list=file_list, coders=coders)
-            doc_coded_paras = defaultdict(lambda: defaultdict(set))
-            for code, coder, doc_path, para_start, para_end in coded_paragraphs:
-                doc_coded_paras[doc_path][(para_start, para_end)].add(code)
-            for doc_path, coded_paras in doc_coded_paras.items():
-                with open(self.corpus.corpus_dir / doc_path) as fh:
-                    lines = [line for line in fh]
-                para_code_count = sum(len(code_set) for code_set in coded_paras.values())
-                print(f"\n{doc_path} ({para_code_count})")
-                print("=" * text_width)
-                for (para_start, para_end), codes in coded_paras.items():
-                    r = range(para_start, para_end)
-                    if show_line_numbers:
-                        print("[{}:{}]".format(r.start, r.stop))
-                    if show_codes:
-                        self.show_text_with_codes(
-                            [lines[i] for i in r],
-                            [codes] + [[] for i in range(para_end - para_start)],
-                            text_width=text_width,
-                        )
-                    else:
-                        self.show_text(
-                            [lines[i] for i in r],
-                            text_width=text_width,
-                        )
-                        print(" ".join(lines[i].strip() for i in r))
+                coded_paragraphs = self.corpus.iter_coded_paragraphs(**query_args)
+                for doc_path, rows in groupby(coded_paragraphs, key=itemgetter(2)):
+                    coded_paras = defaultdict(set)
+                    for code, coder, _, para_start, para_end in rows:
+                        coded_paras[(para_start, para_end)].add(code)
+                    para_code_count = sum(len(code_set) for code_set in coded_paras.values())
+                    print(f"\n{doc_path} ({para_code_count})")
+                    print("=" * text_width)
+                    with self.read_document(doc_path) as reader:
+                        for (para_start, para_end), codes in coded_paras.items():
+                            r = range(para_start, para_end)
+                            lines = reader.get_lines(r.start, r.stop)
+                            if show_line_numbers:
+                                print("[{}:{}]".format(r.start, r.stop))
+                            if show_codes:
+                                self.show_text_with_codes(
+                                    lines,
+                                    [codes] + [[] for i in range(para_end - para_start)],
+                                    text_width=text_width,
+                                )
+                            else:
+                                self.show_text(
+                                    lines,
+                                    text_width=text_width,
+                                )
+                                print(" ".join(line.strip() for line in lines))
         elif unit == "document": 
-            with self.corpus.session():
-                coded_documents = self.corpus.get_coded_documents(codes=codes, 
-                        pattern=pattern, file_list=file_list, coders=coders)
             doc_codes = defaultdict(set)
-            for code, coder, doc_path in coded_documents:
-                doc_codes[doc_path].add(code)
+            with self.corpus.session():
+                for code, coder, doc_path in self.corpus.iter_coded_documents(**query_args):
+                    doc_codes[doc_path].add(code)
             if show_codes:
                 self.show_text_with_codes(
                     doc_codes.keys(),
@@ -468,63 +463,111 @@ class QCCorpusViewer:
         ):
         """Gets json with lines from corpus documents with their codes.
         """
+        return list(self.iter_coded_text_records(codes, 
+            recursive_codes=recursive_codes, 
+            depth=depth,
+            unit=unit,
+            before=before, 
+            after=after, 
+            coders=coders,
+            pattern=pattern,
+            file_list=file_list,
+        ))
+
+    def show_coded_text_jsonl(self, codes, 
+            recursive_codes=False, 
+            depth=None,
+            unit="line",
+            before=2, 
+            after=2, 
+            coders=None,
+            pattern=None,
+            file_list=None,
+        ):
+        """Displays newline-delimited json, one record per line, with lines from 
+        corpus documents with their codes. Records are printed as they are read.
+        """
+        for record in self.iter_coded_text_records(codes, 
+            recursive_codes=recursive_codes, 
+            depth=depth,
+            unit=unit,
+            before=before, 
+            after=after, 
+            coders=coders,
+            pattern=pattern,
+            file_list=file_list,
+        ):
+            print(json.dumps(record))
+
+    def iter_coded_text_records(self, codes, 
+            recursive_codes=False, 
+            depth=None,
+            unit="line",
+            before=2, 
+            after=2, 
+            coders=None,
+            pattern=None,
+            file_list=None,
+        ):
+        """Yields records with lines from corpus documents with their codes, 
+        one document at a time. Coded units are streamed from the database, so 
+        memory use does not grow with the number of records.
+        """
         if recursive_codes:
             codes = set(sum([self.get_child_nodes(code, names=True) for code in codes], []))
         else:
             codes = set(codes)
-        records = []
-        if unit == "line": 
-            with self.corpus.session():
-                coded_lines = self.corpus.get_coded_lines(codes=codes, pattern=pattern, 
-                        file_list=file_list, coders=coders)
-            doc_coded_lines = defaultdict(lambda: defaultdict(set))
-            doc_code_counts = defaultdict(int)
-            for code, coder, line_num, doc_path in coded_lines:
-                doc_code_counts[doc_path] += 1
-                doc_coded_lines[doc_path][line_num].add(code)
-            for doc_path, coded_lines in doc_coded_lines.items():
-                with open(self.corpus.corpus_dir / doc_path) as fh:
-                    lines = [line for line in fh]
-                for line, codes in coded_lines.items():
-                    for code in codes:
-                        line_start = max(0, line - before)
-                        line_end = min(len(lines), line + after + 1)
-                        records.append({
-                            "document": doc_path,
-                            "line": line,
-                            "code": code,
-                            "text_lines": [line_start, line_end],
-                            "text": ''.join(lines[line_start:line_end])
-                        })
-        elif unit == "paragraph":
-            with self.corpus.session():
-                coded_paragraphs = self.corpus.get_coded_paragraphs(codes=codes, 
-                        pattern=pattern, file_list=file_list, coders=coders)
-            doc_coded_paras = defaultdict(lambda: defaultdict(set))
-            for code, coder, doc_path, para_start, para_end in coded_paragraphs:
-                doc_coded_paras[doc_path][(para_start, para_end)].add(code)
-            for doc_path, coded_paras in doc_coded_paras.items():
-                with open(self.corpus.corpus_dir / doc_path) as fh:
-                    lines = [line for line in fh]
-                for (para_start, para_end), codes in coded_paras.items():
-                    for code in codes:
-                        records.append({
-                            "document": doc_path,
-                            "paragraph": [para_start, para_end],
-                            "code": code,
-                            "text": ''.join(lines[para_start:para_end]),
-                        })
-        elif unit == "document": 
-            with self.corpus.session():
-                coded_documents = self.corpus.get_coded_documents(codes=codes, 
-                        pattern=pattern, file_list=file_list, coders=coders)
-            doc_codes = defaultdict(set)
-            for code, coder, doc_path in coded_documents:
-                records.append({
-                    "docuement": doc_path,
-                    "code": code,
-                })
-        return records
+        query_args = dict(codes=codes, pattern=pattern, file_list=file_list, coders=coders)
+        with self.corpus.session():
+            if unit == "line": 
+                coded_lines = self.corpus.iter_coded_lines(**query_args)
+                for doc_path, rows in groupby(coded_lines, key=itemgetter(3)):
+                    line_codes = defaultdict(set)
+                    for code, coder, line_num, _ in rows:
+                        line_codes[line_num].add(code)
+                    with self.read_document(doc_path) as reader:
+                        for line, codes in line_codes.items():
+                            line_start = max(0, line - before)
+                            line_end = min(len(reader), line + after + 1)
+                            text = ''.join(reader.get_lines(line_start, line_end))
+                            for code in codes:
+                                yield {
+                                    "document": doc_path,
+                                    "line": line,
+                                    "code": code,
+                                    "text_lines": [line_start, line_end],
+                                    "text": text
+                                }
+            elif unit == "paragraph":
+                coded_paragraphs = self.corpus.iter_coded_paragraphs(**query_args)
+                for doc_path, rows in groupby(coded_paragraphs, key=itemgetter(2)):
+                    para_codes = defaultdict(set)
+                    for code, coder, _, para_start, para_end in rows:
+                        para_codes[(para_start, para_end)].add(code)
+                    with self.read_document(doc_path) as reader:
+                        for (para_start, para_end), codes in para_codes.items():
+                            text = ''.join(reader.get_lines(para_start, para_end))
+                            for code in codes:
+                                yield {
+                                    "document": doc_path,
+                                    "paragraph": [para_start, para_end],
+                                    "code": code,
+                                    "text": text,
+                                }
+            elif unit == "document": 
+                coded_documents = self.corpus.iter_coded_documents(**query_args)
+                for code, coder, doc_path in coded_documents:
+                    yield {
+                        "docuement": doc_path,
+                        "code": code,
+                    }
+
+    def read_document(self, doc_path):
+        """Returns a DocumentReader for a document. Must be called within a 
+        corpus session.
+        """
+        offsets = self.corpus.get_line_offsets(doc_path)
+        return DocumentReader(self.corpus.corpus_dir / doc_path, offsets)
 
     def show_text(self, lines, text_width=80):
         "Prints lines of text from a corpus document"
@@ -560,7 +603,7 @@ class QCCorpusViewer:
             docs = self.corpus.get_documents(pattern=pattern, file_list=file_list)
             file_paths = set(doc.file_path for doc in docs)
             if uncoded:
-                coded_docs = self.corpus.get_coded_documents(pattern=pattern,
+                coded_docs = self.corpus.iter_coded_documents(pattern=pattern,
                         file_list=file_list, coders=[coder])
                 coded_file_paths = set(fp for code, coder, fp in coded_docs)
                 file_paths = file_paths - coded_file_paths
@@ -746,14 +789,14 @@ class QCCorpusViewer:
     def codes_file_text(self, corpus_file_path, coder):
         """Formats codes for a temporary coding file.
         """
+        codes_per_line = defaultdict(list)
         with self.corpus.session():
-            code_line_docs = self.corpus.get_coded_lines(
+            code_line_docs = self.corpus.iter_coded_lines(
                 file_list=[corpus_file_path], 
                 coders=[coder]
             )
-        codes_per_line = defaultdict(list)
-        for code, coder, line, doc in code_line_docs:
-            codes_per_line[line].append(code)
+            for code, coder, line, doc in code_line_docs:
+                codes_per_line[line].append(code)
 
         text = (self.corpus.corpus_dir / corpus_file_path).read_text().splitlines()
         lines = [', '.join(codes_per_line[i]) for i in range(len(text))]